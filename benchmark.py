@@ -0,0 +1,295 @@
+"""
+This module benchmarks MarkbyEP, MarkbySTD, plot_A4 and run on
+synthetic data, which follows the schemas of the real files but is
+generated from a seed, so the results of different commits can be
+compared. The time (the best of the repeats) and the peak memory
+(by tracemalloc) of every case are written into a json.
+To run the default grid and compare with an earlier result:
+    python benchmark.py --out results/benchmark.json --compare old.json
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# the standards in stds_and_cols.xlsx
+STD_NAMES = ['飲用水水源水質標準第五條',
+    '飲用水水源水質標準第六條', '地下水污染監測標準第一類',
+    '地下水污染監測標準第二類', '地下水污染管制標準第一類',
+    '地下水污染管制標準第二類', '灌溉用水水質標準',
+    '再生水用於工業用途水質基礎建議值一',
+    '再生水用於工業用途水質基礎建議值二']
+
+# some of the analytes in stds_and_cols.xlsx, 氫離子濃度指數 (a range)
+# and 溶氧量 (a lower limit) first, more are named A1, A2, ...
+ANALYTES = ['氫離子濃度指數', '溶氧量', '總硬度', '總溶解固體', '氯鹽',
+    '氨氮', '硝酸鹽氮', '硫酸鹽', '總有機碳', '鐵', '錳', '砷', '鉛', '鎘',
+    '鉻', '銅', '鋅', '汞', '鎳', '氟鹽']
+
+def make_wl(n_sites=100, n_hours=24*14, seed=0):
+    """
+    Synthetic hourly water level of n_sites sites in n_hours hours and
+    their EP table, like the water level in the HDF store and the
+    output of read_ep(). Some sites miss some months in the EP table,
+    so the closet month is used.
+    """
+    rng = np.random.default_rng(seed)
+    sites = np.array([str(1000000 + i) for i in range(n_sites)])
+    dates = pd.date_range('2021-01-01', periods=n_hours, freq=pd.Timedelta(hours=1))
+    base = rng.uniform(2, 30, n_sites)
+    trend = rng.normal(0, 1e-3, n_sites)
+    depth = (base[:, None] + trend[:, None] * np.arange(n_hours)
+        + rng.normal(0, .1, (n_sites, n_hours)))
+    wl_df = pd.DataFrame({
+        '井號': np.repeat(sites, n_hours),
+        '井名': np.repeat(['井{}'.format(i) for i in range(n_sites)], n_hours),
+        '日期時間': np.tile(dates.values, n_sites),
+        '水面至井口深度': depth.ravel(),
+    })
+    wl_df['月'] = wl_df['日期時間'].dt.month
+    # the measurements are not sorted in the store
+    wl_df = wl_df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+    rows = []
+    for i, siteid in enumerate(sites):
+        months = range(1, 13) if i % 4 else [1, 4, 7, 10]
+        for month in months:
+            pct = np.sort(rng.normal(base[i], 2, 6))
+            rows.append([siteid, month] + list(pct))
+    ep_df = pd.DataFrame(rows, columns=['井號', '月', '10', '20', '25', '35', '75', '85'])
+    return wl_df, ep_df
+
+def make_wa(n_sites=50, n_samples=40, n_analytes=20, seed=0):
+    """
+    Synthetic water quality of n_sites sites, each having n_samples
+    samples (every 90 days) of n_analytes analytes, and the standards
+    of them, like the outputs of read_wa() and read_std(). The
+    standards have about 30% of the analytes without a limit, and
+    about 30% of the values are missing.
+    """
+    rng = np.random.default_rng(seed)
+    analytes = (ANALYTES + ['A{}'.format(i) for i in range(1, n_analytes)])[:n_analytes]
+    std_df = pd.DataFrame({
+        '項目': analytes,
+        '單位': ['無單位' if _ == '氫離子濃度指數' else 'mg/L' for _ in analytes],
+    })
+    for j, std_name in enumerate(STD_NAMES):
+        col = []
+        for analyte in analytes:
+            if rng.random() < .3:
+                col.append(np.nan)
+            elif analyte == '氫離子濃度指數':
+                col.append('6.{}-8.5'.format(j))
+            elif analyte == '溶氧量':
+                col.append(round(rng.uniform(2, 4), 1))
+            else:
+                col.append(round(rng.uniform(5, 10), 2))
+        std_df[std_name] = col
+
+    sites = [str(2000000 + i) for i in range(n_sites)]
+    wa_df = pd.DataFrame({
+        '井號': np.repeat(sites, n_samples),
+        '井名': np.repeat(['站{}'.format(i) for i in range(n_sites)], n_samples),
+        '日期時間': np.tile(pd.date_range('1995-01-01 10:00', periods=n_samples, freq='90D').values, n_sites),
+    })
+    for analyte in analytes:
+        if analyte == '氫離子濃度指數':
+            values = rng.normal(7.5, .7, len(wa_df))
+        else:
+            values = rng.lognormal(1, .6, len(wa_df))
+        values[rng.random(len(wa_df)) < .3] = np.nan
+        wa_df[analyte] = values
+    wa_df['日期'] = wa_df['日期時間'].dt.normalize()
+    wa_df = wa_df.sample(frac=1, random_state=seed).reset_index(drop=True)
+    return wa_df, std_df
+
+def measure(func, repeat=3, memory=True):
+    """
+    The best time (s) of repeat calls of func and the peak memory (MB)
+    traced in an extra call, None if memory is False.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return min(times), peak
+
+def bench_MarkbyEP(n_sites, n_hours, repeat=3, memory=True):
+    from visualization import Waterlvl
+
+    wl_df, ep_df = make_wl(n_sites=n_sites, n_hours=n_hours)
+    select = Waterlvl.from_frame(ep_df)
+
+    def cold():
+        # the summaries are cached by the version of the data
+        select.summaries.clear()
+        select.MarkbyEP(wl_df.copy(), criteria='安全')
+
+    def cached():
+        select.MarkbyEP(wl_df, criteria='嚴重', version='benchmark')
+
+    params = {'sites': n_sites, 'hours': n_hours, 'rows': len(wl_df)}
+    results = [dict(case='MarkbyEP', **params, **_result(measure(cold, repeat, memory)))]
+    select.MarkbyEP(wl_df, criteria='安全', version='benchmark')
+    results.append(dict(case='MarkbyEP (cached)', **params, **_result(measure(cached, repeat, memory))))
+    return results
+
+def bench_MarkbySTD(n_sites, n_samples, n_analytes, repeat=3, memory=True):
+    from visualization import Waterquality
+
+    wa_df, std_df = make_wa(n_sites=n_sites, n_samples=n_samples, n_analytes=n_analytes)
+    select = Waterquality.from_frames(wa_df, std_df)
+    df = pd.DataFrame({'井號': wa_df['井號'].unique()})
+
+    def cold():
+        # the pass rates are kept for the later calls
+        select.rate_df = None
+        select.MarkbySTD(df.copy(), STD_NAMES[0])
+
+    def cached():
+        select.MarkbySTD(df.copy(), STD_NAMES[1])
+
+    params = {'sites': n_sites, 'samples': n_samples, 'analytes': n_analytes, 'rows': len(wa_df)}
+    return [
+        dict(case='MarkbySTD', **params, **_result(measure(cold, repeat, memory))),
+        dict(case='MarkbySTD (cached)', **params, **_result(measure(cached, repeat, memory))),
+    ]
+
+def bench_plot_A4(n_samples, n_analytes, exact=False, repeat=3, memory=True):
+    from visualization import Waterquality
+
+    wa_df, std_df = make_wa(n_sites=1, n_samples=n_samples, n_analytes=n_analytes)
+    with tempfile.TemporaryDirectory() as output_dir:
+        select = Waterquality.from_frames(wa_df, std_df, output_dir=output_dir + '/')
+        siteid = wa_df['井號'].values[0]
+        # the standard having the most analytes
+        std_name = max(STD_NAMES, key=lambda _: len(select.site_std_analytes(siteid, _)))
+
+        def func():
+            select.plot_A4(siteid, std_name, savefig=True, exact=exact)
+
+        params = {'samples': n_samples, 'analytes': n_analytes, 'exact': exact,
+            'pages': len(select.site_std_analytes(siteid, std_name))//6 + 1}
+        return [dict(case='plot_A4', **params, **_result(measure(func, repeat, memory)))]
+
+def bench_run(n_sites, processes, repeat=1):
+    from visualization import Waterquality
+
+    wa_df, std_df = make_wa(n_sites=n_sites)
+    with tempfile.TemporaryDirectory() as output_dir:
+        select = Waterquality.from_frames(wa_df, std_df, output_dir=output_dir + '/')
+
+        def func():
+            select.run(processes=processes, std_names=STD_NAMES[:2])
+
+        # tracemalloc doesn't see the other processes
+        params = {'sites': n_sites, 'standards': 2, 'processes': processes}
+        return [dict(case='run', **params, **_result(measure(func, repeat, memory=False)))]
+
+def _result(measured):
+    seconds, peak = measured
+    return {'seconds': round(seconds, 6), 'peak_MB': None if peak is None else round(peak, 3)}
+
+# the grids of the parameters, quick is for a check in a minute or so
+GRIDS = {
+    'quick': {
+        'MarkbyEP': [(100, 24*14), (1000, 24*14)],
+        'MarkbySTD': [(50, 40, 20), (500, 40, 20)],
+        'plot_A4': [(40, 20, False)],
+        'run': [(4, 1)],
+    },
+    'full': {
+        'MarkbyEP': [(100, 24*14), (1000, 24*14), (1000, 24*90), (5000, 24*30)],
+        'MarkbySTD': [(50, 40, 20), (500, 40, 20), (500, 200, 20), (500, 40, 60)],
+        'plot_A4': [(40, 20, False), (40, 60, False), (20000, 20, False), (20000, 20, True)],
+        'run': [(20, 1), (20, 4)],
+    },
+}
+
+def benchmark(grid='quick', repeat=3, memory=True):
+    """
+    Run the cases of the grid, the output is a list of dict of the
+    parameters and the results of each case.
+    """
+    import matplotlib.pyplot as plt
+
+    plt.switch_backend('Agg')
+    grid = GRIDS[grid]
+    results = []
+    for params in grid['MarkbyEP']:
+        results += bench_MarkbyEP(*params, repeat=repeat, memory=memory)
+    for params in grid['MarkbySTD']:
+        results += bench_MarkbySTD(*params, repeat=repeat, memory=memory)
+    for params in grid['plot_A4']:
+        results += bench_plot_A4(*params, repeat=repeat, memory=memory)
+    for params in grid['run']:
+        results += bench_run(*params)
+    return results
+
+def environment():
+    """
+    The commit and versions the benchmark runs on.
+    """
+    import subprocess
+    import matplotlib
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'time': pd.Timestamp.now().isoformat(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'matplotlib': matplotlib.__version__,
+    }
+
+def _label(result):
+    return ', '.join('{}={}'.format(k, v) for k, v in result.items() if k not in ['seconds', 'peak_MB'])
+
+def compare(results, old_results):
+    """
+    Print the time ratio (new / old) of the cases in both results.
+    """
+    old = {_label(_): _ for _ in old_results}
+    for result in results:
+        label = _label(result)
+        if label in old:
+            print('{:.2f}x  {}'.format(result['seconds'] / old[label]['seconds'], label))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the screening and the figures on synthetic data.')
+    parser.add_argument('--grid', default='quick', choices=GRIDS.keys())
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracing the peak memory')
+    parser.add_argument('--out', default='results/benchmark.json')
+    parser.add_argument('--compare', help='an earlier output to compare with')
+    args = parser.parse_args()
+
+    results = benchmark(grid=args.grid, repeat=args.repeat, memory=not args.no_memory)
+    for result in results:
+        print('{:10.4f} s {:>10} MB  {}'.format(result['seconds'],
+            '-' if result['peak_MB'] is None else result['peak_MB'], _label(result)))
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'grid': args.grid, 'results': results},
+            f, ensure_ascii=False, indent=1)
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f)['results'])
@@ -0,0 +1,339 @@
+"""
+This module is built for building the database from the raw files,
+following the steps in the build_database notebooks but in bounded
+memory. The results are appended to a HDF store (needs PyTables) in
+table format, so they can be queried by 井號 and 日期時間 later.
+"""
+import os
+import json
+import warnings
+import numpy as np
+import pandas as pd
+import datacache
+from wells import WellRegistry, normalize_id, read_wells
+
+# PyTables warns about the Chinese column names, which work fine
+warnings.filterwarnings('ignore', message='object name is not a valid Python identifier')
+
+# the 24 hourly columns in *_自記站時水位.csv
+HOURS = ['{}:00:00'.format(hr) for hr in range(24)]
+
+# the string sizes reserved in the HDF tables, since they can't grow
+# after the table is created
+MIN_ITEMSIZE = {'井名': 60, '井號': 20}
+
+def read_hourly_csv(csv, chunksize=100000):
+    """
+    Read a WRA water level csv before 2019 (*_自記站時水位.csv, big5,
+    one row per day with 24 hourly columns) chunk by chunk.
+    It's a generator of pd.DataFrame in long format with columns of
+    井名, 井號, 日期時間, 水位(m), each from at most chunksize rows
+    (days) of the csv. 井號 is normalized by wells.normalize_id() (no
+    leading zeros) as in the EP and the water quality data. 水位(m) is
+    float32 and the non-numeric values (缺測) are NaN.
+    """
+    for df in pd.read_csv(csv, encoding='big5', dtype=str, chunksize=chunksize):
+        df.columns = np.hstack([['管理單位', '井名', '井號', '觀測日期'], HOURS])
+        # the date is followed by a time part, e.g. '2010/1/1 上午 12:00:00'
+        date = pd.to_datetime(df['觀測日期'].str.split().str[0]).values
+        yield pd.DataFrame({
+            # cut off the space tail of 井名
+            '井名': np.repeat(df['井名'].str.split().str[0].values, 24),
+            '井號': np.repeat(normalize_id(df['井號']), 24),
+            '日期時間': (date[:, None] + np.arange(24).astype('timedelta64[h]')).ravel(),
+            '水位(m)': pd.to_numeric(df[HOURS].values.ravel(), errors='coerce', downcast='float'),
+        })
+
+def read_station_csv(csv, chunksize=100000):
+    """
+    Read a WRA water level csv of 2019 (one file per station, named as
+    井名(井號)_XXX.csv, big5) chunk by chunk, in the same format as
+    read_hourly_csv.
+    """
+    well_name, well_no = os.path.basename(csv).split(')_')[0].split('(')
+    for df in pd.read_csv(csv, encoding='big5', dtype=str, skiprows=2, chunksize=chunksize):
+        yield pd.DataFrame({
+            '井名': well_name,
+            '井號': normalize_id([well_no])[0],
+            '日期時間': pd.to_datetime(df.iloc[:, 0]).values,
+            '水位(m)': pd.to_numeric(df.iloc[:, 1].values, errors='coerce', downcast='float'),
+        })
+
+def read_gw_csv(csv, chunksize=100000):
+    """
+    Read a WRA water level csv after 2019 (GW_*.csv, big5, downloaded 
+    from 及時地下水) chunk by chunk, in the same format as 
+    read_hourly_csv.
+    """
+    for df in pd.read_csv(csv, encoding='big5', dtype=str, chunksize=chunksize):
+        df.columns = ['管理單位', '地下水分區', '井號', '井名', '井頂高程(m)', '日期時間', '水位(m)']
+        yield pd.DataFrame({
+            '井名': df['井名'].str.strip().values,
+            '井號': normalize_id(df['井號']),
+            '日期時間': pd.to_datetime(df['日期時間']).values,
+            '水位(m)': pd.to_numeric(df['水位(m)'].values, errors='coerce', downcast='float'),
+        })
+
+def read_raw(csv, chunksize=100000):
+    """
+    Read any of the three formats of the WRA water level csv, decided
+    by the file name.
+    """
+    name = os.path.basename(csv)
+    if name.endswith('_自記站時水位.csv'):
+        return read_hourly_csv(csv, chunksize=chunksize)
+    elif name.startswith('GW_'):
+        return read_gw_csv(csv, chunksize=chunksize)
+    else:
+        return read_station_csv(csv, chunksize=chunksize)
+
+def parse_censored(values):
+    """
+    Split the raw lab values (a pd.Series of numbers and strings) of an
+    analyte at once into a pd.DataFrame of
+    value: the numeric value, half of the MDL when it's below the 
+        detection limit, NaN when there is no measurement (--).
+    censored: below the detection limit, as '<0.001' or 'MDL'.
+    MDL: the detection limit, e.g. 0.001 of '<0.001'. It is NaN for 
+        'MDL', which is given by the MDL table in parse_censored_frame().
+    """
+    text = values.astype(str).str.strip()
+    less = text.str.startswith('<')
+    mdl = pd.to_numeric(text.str[1:].where(less), errors='coerce')
+    censored = less | (text.str.upper() == 'MDL')
+    value = pd.to_numeric(values.where(~censored), errors='coerce').astype(float)
+    # use the half of the MDL as the value
+    value = value.where(~censored, mdl / 2)
+    return pd.DataFrame({'value': value.values, 'censored': censored.values, 
+        'MDL': mdl.astype(float).values}, index=values.index)
+
+def read_mdl(mdl_dir='data/水利署報告書MDL整理.xlsx'):
+    """
+    Read the MDL of each Year (a column) and analyte (the other columns)
+    in the reports.
+    """
+    return pd.read_excel(mdl_dir, sheet_name=1)
+
+def parse_censored_frame(df, analytes, mdl_df=None, year_col=None):
+    """
+    Parse the analyte columns of df by parse_censored(), and keep the
+    flags in the columns of {analyte}_censored and {analyte}_MDL, so
+    Waterquality.MarkbySTD() can treat the values below the detection
+    limit without parsing them again. The analyte columns become float.
+    With mdl_df (see read_mdl()), the MDL of the year (year_col, or 
+    the year of 日期時間) and the analyte is joined to the rows, and
+    used for 'MDL' and the invalid values (9999.999 and negative) as
+    in buld_database_04.
+    """
+    df = df.copy()
+    mdls = None
+    if mdl_df is not None:
+        years = df[year_col] if year_col is not None else df['日期時間'].dt.year
+        # the MDL table joined to every row by year
+        mdls = mdl_df.drop_duplicates('Year').set_index('Year').reindex(
+            pd.to_numeric(years, errors='coerce').values)
+    for analyte in analytes:
+        parsed = parse_censored(df[analyte])
+        value, censored, mdl = parsed['value'].values, parsed['censored'].values, parsed['MDL'].values
+        if mdls is not None and analyte in mdls.columns:
+            table = pd.to_numeric(mdls[analyte], errors='coerce').values
+            invalid = (value == 9999.999) | (value < 0)
+            censored = censored | invalid
+            mdl = np.where(censored & np.isnan(mdl), table, mdl)
+            value = np.where(censored & np.isnan(value), mdl / 2, value)
+            value = np.where(invalid, mdl / 2, value)
+        df[analyte] = value
+        df['{}_censored'.format(analyte)] = censored
+        df['{}_MDL'.format(analyte)] = mdl
+    return df
+
+def append(store, key, df):
+    """
+    Append df to the table of key in the HDFStore, with 井號 and 日期時間
+    as data columns. The PyTables index is built later by index().
+    """
+    data_columns = [_ for _ in ['井號', '日期時間'] if _ in df.columns]
+    min_itemsize = {k: v for k, v in MIN_ITEMSIZE.items() if k in df.columns}
+    store.append(key, df, format='table', data_columns=data_columns,
+        min_itemsize=min_itemsize, encoding='utf-8', index=False)
+
+def index(store, key):
+    """
+    Build the PyTables index of 井號 and 日期時間 of the table of key.
+    """
+    store.create_table_index(key, columns=['井號', '日期時間'], optlevel=9, kind='full')
+
+def ingest_hourly(csvs, store_dir, key='wl_before2019', chunksize=100000):
+    """
+    Stream the hourly water level csvs (see read_hourly_csv) into the
+    table of key in the HDF store of store_dir, one chunk at a time,
+    so the memory doesn't grow with the amount of files.
+    The output is the amount of the appended rows.
+    """
+    rows = 0
+    with pd.HDFStore(store_dir, mode='a') as store:
+        for csv in csvs:
+            for X in read_hourly_csv(csv, chunksize=chunksize):
+                append(store, key, X)
+                rows += len(X)
+            print('{} is ingested.'.format(csv))
+        index(store, key)
+    return rows
+
+def to_table(src_dir, store_dir, keys=['wl', 'wa'], chunksize=1000000):
+    """
+    Copy the keys of the HDF store of src_dir (e.g. 
+    database_ZAF_clean_gps_20211104.hd5, in fixed format) to the HDF
+    store of store_dir in table format with 井號 and 日期時間 as indexed
+    data columns, so they can be queried without loading the whole 
+    table (see Waterlvl.read()). Each key is loaded once here.
+    """
+    with pd.HDFStore(store_dir, mode='a') as store:
+        for key in keys:
+            df = pd.read_hdf(src_dir, key=key)
+            if '井號' in df.columns:
+                df['井號'] = df['井號'].astype(str)
+            if key in store:
+                store.remove(key)
+            for i in range(0, len(df), chunksize):
+                append(store, key, df.iloc[i:i+chunksize])
+            index(store, key)
+            print('{} is copied ({} rows).'.format(key, len(df)))
+
+class Builder():
+    """
+    This is a class to build the water level database incrementally.
+    The stages are the same as the build_database notebooks: read the
+    raw files, keep the wells in 環保署水利署地下水井.xlsx having the
+    well elevation (SiteEl) in elev_dir, clean 水位(m), attach GPS and
+    SiteEl, compute 水面至井口深度 and 月, and export. The results are
+    appended to the HDF store of store_dir in tables partitioned by 
+    year (key wl/yYYYY) with 井號 and 日期時間 as indexed data columns,
+    so the rows of a site are selected by the index instead of a table
+    for each site.
+    A manifest (json) records the size, mtime and sha256 of every 
+    processed file, so only new or changed files are processed by 
+    update(). The rows having the same (井號, 日期時間) as the stored
+    ones replace them.
+    """
+
+    def __init__(
+        self,
+        store_dir = 'data/database_ZAF_wl.hd5',
+        manifest_dir = None,
+        well_dir = 'data/環保署水利署地下水井.xlsx',
+        elev_dir = 'data/地下水觀測網抽水試驗成果彙整-V2.xlsx',
+        chunksize = 100000
+    ):
+        self.store_dir = store_dir
+        if manifest_dir is None:
+            manifest_dir = store_dir + '.manifest.json'
+        self.manifest_dir = manifest_dir
+        self.chunksize = chunksize
+        wells = read_wells(well_dir)
+        elev = pd.read_excel(elev_dir, sheet_name='濁水溪沖積扇')
+        elev = pd.DataFrame({
+            '井號': normalize_id(elev['井號']),
+            'SiteEl': elev['井頂高程\n(m)'].values,
+        }).drop_duplicates('井號')
+        wells = wells.merge(elev, on='井號', how='inner')
+        # the elevation is attached with the coordinates
+        self.registry = WellRegistry.from_frame(wells)
+        self.manifest = {}
+        if os.path.isfile(self.manifest_dir):
+            with open(self.manifest_dir, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+
+    def changed(self, csv):
+        """
+        Check if the csv is new or changed since it was processed. The 
+        output is the file info to be recorded, or None if unchanged.
+        """
+        stat = os.stat(csv)
+        info = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        record = self.manifest.get(os.path.abspath(csv))
+        if record is not None and record['size'] == info['size'] and record['mtime'] == info['mtime']:
+            return None
+        info['sha256'] = datacache.file_digest(csv)
+        if record is not None and record['sha256'] == info['sha256']:
+            record['mtime'] = info['mtime']
+            return None
+        return info
+
+    def process(self, X):
+        """
+        Filter, clean and attach GPS and SiteEl to a chunk from 
+        read_raw().
+        """
+        # only the wells in the list, and it's 井名 is used. 井號 is 
+        # normalized by read_raw() already
+        X = self.registry.attach(X, normalize=False)
+        # -999998 is the instrument defect
+        X.loc[X['水位(m)'] <= -500, '水位(m)'] = np.nan
+        # the water level shouldn't be higher than the well surface
+        X.loc[X['水位(m)'] >= X['SiteEl'] + 1, '水位(m)'] = np.nan
+        X['水面至井口深度'] = X['SiteEl'] - X['水位(m)']
+        X['月'] = X['日期時間'].dt.month.astype(np.int8)
+        return X
+
+    def export(self, store, X):
+        """
+        Append X to the yearly tables, replacing the stored rows with 
+        the same (井號, 日期時間). The output is the keys written.
+        """
+        X = X.drop_duplicates(['井號', '日期時間'], keep='last')
+        keys = []
+        for year, Y in X.groupby(X['日期時間'].dt.year):
+            key = 'wl/y{}'.format(year)
+            if key in store:
+                sites = list(Y['井號'].unique())
+                lo, hi = Y['日期時間'].min(), Y['日期時間'].max()
+                coords = store.select_as_coordinates(key, where='井號 in sites & 日期時間 >= lo & 日期時間 <= hi')
+                if len(coords) > 0:
+                    old = store.select(key, where=coords, columns=['井號', '日期時間'])
+                    dup = pd.MultiIndex.from_frame(old[['井號', '日期時間']]).isin(
+                        pd.MultiIndex.from_frame(Y[['井號', '日期時間']]))
+                    if dup.any():
+                        store.remove(key, where=coords[dup])
+            append(store, key, Y)
+            keys.append(key)
+        return keys
+
+    def update(self, csvs):
+        """
+        Process the new or changed csvs (any format of read_raw) into
+        the store. The output is the amount of the appended rows.
+        """
+        rows = 0
+        with pd.HDFStore(self.store_dir, mode='a') as store:
+            keys = set()
+            for csv in csvs:
+                info = self.changed(csv)
+                if info is None:
+                    continue
+                info['rows'] = 0
+                for X in read_raw(csv, chunksize=self.chunksize):
+                    X = self.process(X)
+                    keys.update(self.export(store, X))
+                    info['rows'] += len(X)
+                rows += info['rows']
+                # record the file only after all of it is stored
+                self.manifest[os.path.abspath(csv)] = info
+                self.save_manifest()
+                print('{} is processed ({} rows).'.format(csv, info['rows']))
+            for key in keys:
+                index(store, key)
+        self.save_manifest()
+        return rows
+
+    def save_manifest(self):
+        datacache.write_json(self.manifest_dir, self.manifest)
+
+if __name__ == '__main__':
+    import glob
+
+    builder = Builder()
+    builder.update(sorted(glob.glob('data/*/*_自記站時水位.csv')))
+    for i in range(1, 11):
+        builder.update(sorted(glob.glob('data/{}/*.csv'.format(i))))
+    builder.update(sorted(glob.glob('data/GW_*.csv')))
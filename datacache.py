@@ -0,0 +1,133 @@
+"""
+This module caches the parsed input files (Excel, csv) on disk, so
+Waterquality and Waterlvl don't have to parse them again every time.
+A cached pd.DataFrame is stored in parquet (or pickle if the frame
+can't be stored in parquet) with a json recording the size, mtime and
+sha256 of the source file. The cache is rebuilt automatically when the
+source file is changed.
+To pre-warm the cache of the default files:
+    python datacache.py
+"""
+import os
+import json
+import hashlib
+import pandas as pd
+
+def file_digest(path, block_size=1<<20):
+    """
+    The sha256 (hex) of the content of a file.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def reader_version(reader):
+    """
+    A hash of the code of the reader (the bytecode, the constants and
+    the names, also of the nested functions), so the cached frames of
+    an older reader are not used after it is changed.
+    """
+    h = hashlib.sha1()
+
+    def update(code):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode('utf-8'))
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                # the repr of a code object has its address
+                update(const)
+            else:
+                h.update(repr(const).encode('utf-8'))
+
+    update(reader.__code__)
+    return h.hexdigest()[:12]
+
+def load(path, reader, cache_dir='data/cache/', **kwargs):
+    """
+    Return reader(path, **kwargs), which needs to be a pd.DataFrame,
+    from the cache in cache_dir if the source file isn't changed.
+    The cache is keyed by the source path, the reader (with the hash
+    of its code, see reader_version()) and kwargs, and checked by the size, mtime and content hash of the source. When
+    only the mtime is changed (e.g. copied), the content hash decides.
+    Set cache_dir to None to read the source directly.
+    """
+    if cache_dir is None:
+        return reader(path, **kwargs)
+    version = reader_version(reader)
+    key = '{}|{}|{}|{}'.format(os.path.abspath(path), reader.__name__, version, sorted(kwargs.items()))
+    name = '{}_{}'.format(os.path.splitext(os.path.basename(path))[0],
+        hashlib.sha1(key.encode('utf-8')).hexdigest()[:12])
+    info_path = os.path.join(cache_dir, name + '.json')
+    stat = os.stat(path)
+    info = None
+    if os.path.isfile(info_path):
+        with open(info_path, encoding='utf-8') as f:
+            info = json.load(f)
+    if info is not None and os.path.isfile(os.path.join(cache_dir, info['file'])):
+        if info['size'] == stat.st_size and info['mtime'] == stat.st_mtime_ns:
+            return _read(os.path.join(cache_dir, info['file']), info['format'])
+        if info['size'] == stat.st_size and info['sha256'] == file_digest(path):
+            info['mtime'] = stat.st_mtime_ns
+            write_json(info_path, info)
+            return _read(os.path.join(cache_dir, info['file']), info['format'])
+
+    df = reader(path, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    info = {
+        'source': os.path.abspath(path),
+        'reader': reader.__name__,
+        'reader_version': version,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha256': file_digest(path),
+    }
+    try:
+        df.to_parquet(os.path.join(cache_dir, name + '.parquet'), index=False)
+        info['format'], info['file'] = 'parquet', name + '.parquet'
+    except Exception:
+        # e.g. pyarrow is not installed or there are mixed types in a column
+        df.to_pickle(os.path.join(cache_dir, name + '.pkl'))
+        info['format'], info['file'] = 'pickle', name + '.pkl'
+    write_json(info_path, info)
+    return df
+
+def _read(path, format):
+    if format == 'parquet':
+        return pd.read_parquet(path)
+    else:
+        return pd.read_pickle(path)
+
+def write_json(path, obj, indent=1):
+    """
+    Write obj to the json of path. It's written to a temporary file
+    first, so a broken json is never left if the writing is stopped.
+    """
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=indent)
+    os.replace(path + '.tmp', path)
+
+def warm(wa_dir='data/database_ZAF_wa_merged_20211031.xlsx',
+    excel_dir='data/stds_and_cols.xlsx', ep_dir='data/wl_EP_20211107.csv',
+    cache_dir='data/cache/'):
+    """
+    Build (or check) the cache of the files loaded by Waterquality and
+    Waterlvl.
+    """
+    import visualization
+
+    visualization.Waterquality(wa_dir=wa_dir, excel_dir=excel_dir, cache_dir=cache_dir)
+    visualization.Waterlvl(ep_dir=ep_dir, cache_dir=cache_dir)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pre-warm the cache of the input files.')
+    parser.add_argument('--wa', default='data/database_ZAF_wa_merged_20211031.xlsx')
+    parser.add_argument('--std', default='data/stds_and_cols.xlsx')
+    parser.add_argument('--ep', default='data/wl_EP_20211107.csv')
+    parser.add_argument('--cache-dir', default='data/cache/')
+    args = parser.parse_args()
+    warm(wa_dir=args.wa, excel_dir=args.std, ep_dir=args.ep, cache_dir=args.cache_dir)
+    print('The cache in {} is ready.'.format(args.cache_dir))
@@ -0,0 +1,155 @@
+"""
+This module records where the time of the screening goes. Waterlvl
+and Waterquality take an Instrument (instrument=...) and record the
+wall time, calls and rows of their stages (reading files, summarizing,
+drawing, saving figures, ...), with the siteid when the stage is for
+a site. Every record is a json line written to the sink, e.g.
+    from instrument import Instrument
+    select = Waterquality(instrument=Instrument(sink='results/stages.jsonl'))
+    select.run()
+    print(select.instrument.summary())
+The stages named in profile (or memory) are also wrapped by cProfile
+(or tracemalloc), and any region can be recorded by stage() as well.
+"""
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+class Instrument():
+    """
+    sink is the path of the json lines file (appended), or a file-like
+    object, or None to keep the records in records instead, at most
+    the latest maxlen of them, so a long run doesn't keep growing. 
+    With a sink, only the totals are kept in the memory. profile and
+    memory are the names of the stages to profile by cProfile (the top
+    lines of the stats are recorded) and to trace the peak memory by
+    tracemalloc, or True for all stages. Set enabled to False to
+    record nothing, which is the default of the classes.
+    """
+
+    def __init__(self, sink=None, profile=(), memory=(), enabled=True, top=20, maxlen=10000):
+        self.sink = sink
+        self.profile = profile
+        self.memory = memory
+        self.enabled = enabled
+        self.top = top
+        self.maxlen = maxlen
+        self.records = deque(maxlen=maxlen)
+        self.totals = {}
+        self._profiling = False
+
+    @contextmanager
+    def stage(self, name, profile=False, memory=False, **fields):
+        """
+        Record the wall time of the region in the with block as the
+        stage name, with the extra fields (e.g. rows, siteid). The
+        yielded record (dict) can be updated in the block, e.g. with
+        the rows known only afterwards.
+        """
+        record = dict(stage=name, **fields)
+        if not self.enabled:
+            yield record
+            return
+        profile = (profile or self._chosen(self.profile, name)) and not self._profiling
+        memory = (memory or self._chosen(self.memory, name)) and not tracemalloc.is_tracing()
+        if profile:
+            # cProfile can't be nested
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+        if memory:
+            tracemalloc.start()
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if memory:
+                record['peak_MB'] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+            if profile:
+                profiler.disable()
+                self._profiling = False
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(self.top)
+                record['profile'] = out.getvalue()
+            self.emit(record)
+
+    def _chosen(self, names, name):
+        return names is True or name in names
+
+    def count(self, name, **fields):
+        """
+        Record an event without timing, e.g. a hit of a cache.
+        """
+        if self.enabled:
+            self.emit(dict(stage=name, time=time.strftime('%Y-%m-%dT%H:%M:%S'), seconds=0., **fields))
+
+    def emit(self, record):
+        record['pid'] = os.getpid()
+        total = self.totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0., 'rows': 0})
+        total['calls'] += 1
+        total['seconds'] += record.get('seconds', 0.)
+        total['rows'] += record.get('rows') or 0
+        if self.sink is None:
+            self.records.append(record)
+            return
+        line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+        if isinstance(self.sink, str):
+            # opened for every record, so the processes of run() can
+            # append to the same file
+            with open(self.sink, 'a', encoding='utf-8') as f:
+                f.write(line)
+        else:
+            self.sink.write(line)
+            self.sink.flush()
+
+    def summary(self):
+        """
+        The calls, seconds and rows of each stage recorded in this
+        process, as a pd.DataFrame sorted by seconds.
+        """
+        import pandas as pd
+
+        df = pd.DataFrame.from_dict(self.totals, orient='index', columns=['calls', 'seconds', 'rows'])
+        return df.sort_values('seconds', ascending=False)
+
+    def sites(self, stage=None):
+        """
+        The records having a siteid (of the stage) kept in records, as
+        a pd.DataFrame, to find the slow sites. They are kept only when
+        there is no sink (the latest maxlen ones), otherwise read the 
+        sink by read(), which also has the records of the processes 
+        of run().
+        """
+        import pandas as pd
+
+        records = [_ for _ in self.records if 'siteid' in _ and (stage is None or _['stage'] == stage)]
+        return pd.DataFrame(records)
+
+    def __getstate__(self):
+        # a file-like sink can't go to the other processes, and the
+        # records there are only written to the sink
+        state = self.__dict__.copy()
+        if not isinstance(self.sink, str):
+            state['sink'] = None
+        state['records'] = deque(maxlen=self.maxlen)
+        state['totals'] = {}
+        state['_profiling'] = False
+        return state
+
+def read(sink):
+    """
+    Read the json lines of a sink into a pd.DataFrame.
+    """
+    import pandas as pd
+
+    with open(sink, encoding='utf-8') as f:
+        return pd.DataFrame([json.loads(_) for _ in f if _.strip()])
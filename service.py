@@ -0,0 +1,354 @@
+"""
+This module keeps Waterlvl and Waterquality in one resident process,
+so the notebooks and the scheduled jobs on the same machine query the
+screening without reading the Excel files and building the indexes
+every time. It is a small HTTP server (JSON in and out) on localhost
+or a Unix socket, e.g.
+    python service.py --port 8765
+    curl -X POST localhost:8765/markbyep -d '{"start": "2021-05-01", "criteria": "下限"}'
+or in python
+    from service import query
+    df = query('markbystd', {'siteids': ['2050311'], 'std_name': '灌溉用水水質標準'})
+The endpoints are
+    GET  /health      the loaded files and the pending requests
+    POST /markbyep    {siteids, start, end, criteria}
+    POST /markbystd   {siteids, start, end, std_name or std_names}
+    POST /render      {siteid, std_name, max_points, exact}
+    POST /reload      load the changed files again
+The requests arriving together (within delay) for the same time window
+are answered by one read and one screening of all their sites, and the
+source files are polled and reloaded when they change.
+"""
+import os
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from visualization import Waterlvl, Waterquality, SummaryCache
+
+class Batcher():
+    """
+    Collect the requests of the same key arriving within delay (in
+    seconds) and run them by run(key, requests) at once in the
+    executor, which outputs a result for each request.
+    """
+
+    def __init__(self, run, executor, delay=0.01):
+        self.run = run
+        self.executor = executor
+        self.delay = delay
+        self.pending = {}
+
+    async def submit(self, key, request):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if key not in self.pending:
+            self.pending[key] = []
+            loop.call_later(self.delay, lambda: asyncio.ensure_future(self.flush(key)))
+        self.pending[key].append((request, future))
+        return await future
+
+    async def flush(self, key):
+        batch = self.pending.pop(key)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.run, key, [_ for _, _f in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def __len__(self):
+        return sum(len(_) for _ in self.pending.values())
+
+class Service():
+    """
+    The data are loaded once here. store_dir is the water level store
+    built by database.Builder (None if there is none, then markbyep is
+    not available). The queries and the figures are computed by
+    threads of the executor, one query and one figure at a time, since
+    the classes (and matplotlib) are not thread-safe. The files are
+    checked every poll seconds (None to disable).
+    """
+
+    def __init__(
+        self,
+        store_dir = 'data/database_ZAF_wl.hd5',
+        store_key = 'wl',
+        ep_dir = 'data/wl_EP_20211107.csv',
+        wa_dir = 'data/database_ZAF_wa_merged_20211031.xlsx',
+        excel_dir = 'data/stds_and_cols.xlsx',
+        output_dir = 'results/',
+        cache_dir = 'data/cache/',
+        threads = 4,
+        delay = 0.01,
+        poll = 5
+    ):
+        self.store_dir = store_dir
+        self.store_key = store_key
+        self.poll = poll
+        self.wl = Waterlvl(ep_dir=ep_dir, cache_dir=cache_dir)
+        self.wq = Waterquality(wa_dir=wa_dir, excel_dir=excel_dir, output_dir=output_dir, cache_dir=cache_dir)
+        # the Waterquality of the recently used time windows
+        self.windows = SummaryCache(8)
+        # one for the queries and one for the figures
+        self.query_lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(threads)
+        self.batchers = {
+            'markbyep': Batcher(self.run_markbyep, self.executor, delay),
+            'markbystd': Batcher(self.run_markbystd, self.executor, delay),
+            'render': Batcher(self.run_render, self.executor, delay),
+        }
+        self.mtimes = self.file_mtimes()
+        self.loaded = pd.Timestamp.now().isoformat()
+
+    def files(self):
+        return [self.store_dir, self.wl.ep_dir, self.wq.wa_dir, self.wq.excel_dir]
+
+    def file_mtimes(self):
+        return [os.path.getmtime(_) if _ is not None and os.path.exists(_) else None for _ in self.files()]
+
+    def reload(self):
+        """
+        Load the changed files again (see Waterlvl.reload() and
+        Waterquality.reload()). The water level store is read at every
+        query, and its summaries are cached by its mtime.
+        """
+        with self.query_lock, self.render_lock:
+            self.mtimes = self.file_mtimes()
+            changed = {'ep': self.wl.reload(), 'wa': self.wq.reload()}
+            if changed['wa']:
+                self.windows.clear()
+            self.loaded = pd.Timestamp.now().isoformat()
+        return changed
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.poll)
+            if self.file_mtimes() != self.mtimes:
+                try:
+                    changed = await loop.run_in_executor(self.executor, self.reload)
+                    print('reloaded: {}'.format(changed))
+                except Exception as e:
+                    # keep the loaded data, and try again at the next change
+                    print('failed to reload: {}'.format(e))
+
+    def run_markbyep(self, key, requests):
+        start, end = key
+        siteids = union([_['siteids'] for _ in requests])
+        version = json.dumps([self.store_dir, os.path.getmtime(self.store_dir), start, end, siteids])
+        out = {}
+        with self.query_lock:
+            summary = self.wl.summaries.get(version)
+            for criteria in set(_['criteria'] for _ in requests):
+                if summary is not None:
+                    marked = self.wl.mark_summary(summary, criteria)
+                else:
+                    df = self.wl.read(self.store_dir, start, end, siteids, key=self.store_key)
+                    if len(df) == 0:
+                        out[criteria] = pd.DataFrame(columns=['日期時間', '井號', 'wl_check'])
+                        continue
+                    marked = self.wl.MarkbyEP(df, criteria, version=version)
+                    summary = self.wl.summaries.get(version)
+                out[criteria] = marked.reset_index().rename(columns={'index': '日期時間'})
+        return [pick(out[_['criteria']], _['siteids']) for _ in requests]
+
+    def run_markbystd(self, key, requests):
+        start, end = key
+        siteids = union([_['siteids'] for _ in requests])
+        std_names = [_ for _ in self.wq.std_names if any(_ in r['std_names'] for r in requests)]
+        with self.query_lock:
+            select = self.window(start, end)
+            if siteids is None:
+                siteids = list(select.siteids)
+            out = select.MarkbySTDs(pd.DataFrame({'井號': siteids}), std_names)
+        return [pick(out, r['siteids'])[['井號'] + r['std_names']] for r in requests]
+
+    def window(self, start, end):
+        """
+        The Waterquality of the samples between start and end (end
+        excluded), the whole history if both are None.
+        """
+        if start is None and end is None:
+            return self.wq
+        key = (self.wq.version, start, end)
+        select = self.windows.get(key)
+        if select is None:
+            dates = self.wq.wa_df['日期時間']
+            mask = pd.Series(True, index=dates.index)
+            if start is not None:
+                mask &= dates >= pd.Timestamp(start)
+            if end is not None:
+                mask &= dates < pd.Timestamp(end)
+            select = Waterquality.from_frames(self.wq.wa_df[mask], self.wq.std_df,
+                self.wq.output_dir, self.wq.std_names)
+            self.windows.put(key, select)
+        return select
+
+    def run_render(self, key, requests):
+        siteid, std_name, max_points, exact = key
+        with self.render_lock:
+            self.wq.plot_A4(siteid, std_name, savefig=True, max_points=max_points, exact=exact)
+            pages = len(self.wq.site_summary(siteid)['analytes'][std_name])//6 + 1
+        files = ['{}batch/{}_{}_{}.png'.format(self.wq.output_dir, siteid, std_name, _) for _ in range(pages)]
+        # the same figures for the same requests
+        return [{'files': files}]*len(requests)
+
+    async def handle(self, method, path, body):
+        """
+        The output (status, dict) of a request.
+        """
+        if method == 'GET' and path == '/health':
+            return 200, {
+                'status': 'ok',
+                'loaded': self.loaded,
+                'files': dict(zip(['store', 'ep', 'wa', 'std'], self.files())),
+                'sites': {'wl': int(self.wl.ep_df['井號'].nunique()), 'wa': len(self.wq.siteids)},
+                'pending': {k: len(v) for k, v in self.batchers.items()},
+            }
+        if method != 'POST':
+            return 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+        if path == '/reload':
+            loop = asyncio.get_running_loop()
+            return 200, await loop.run_in_executor(self.executor, self.reload)
+        if path == '/markbyep':
+            if self.store_dir is None or not os.path.exists(self.store_dir):
+                return 404, {'error': 'there is no water level store'}
+            criteria = body.get('criteria', '安全')
+            if criteria not in Waterlvl.criterias['decreasing']:
+                return 400, {'error': 'Please set the criteria in the list of {}'.format(
+                    list(Waterlvl.criterias['decreasing']))}
+            key = (body.get('start'), body.get('end'))
+            df = await self.batchers['markbyep'].submit(key, {
+                'siteids': ids(body.get('siteids')), 'criteria': criteria})
+            return 200, {'rows': records(df)}
+        if path == '/markbystd':
+            std_names = body.get('std_names', [body['std_name']] if 'std_name' in body else self.wq.std_names)
+            wrong = [_ for _ in std_names if _ not in self.wq.std_names]
+            if len(wrong) > 0:
+                return 400, {'error': 'Please input the std_name (法規名稱) in the list: {}'.format(self.wq.std_names)}
+            key = (body.get('start'), body.get('end'))
+            df = await self.batchers['markbystd'].submit(key, {
+                'siteids': ids(body.get('siteids')), 'std_names': std_names})
+            return 200, {'rows': records(df)}
+        if path == '/render':
+            siteid, std_name = str(body.get('siteid')), body.get('std_name')
+            if siteid not in self.wq.site_rows or std_name not in self.wq.std_names:
+                return 400, {'error': 'Please check the siteid (井號) and std_name (法規名稱) again.'}
+            key = (siteid, std_name, body.get('max_points'), bool(body.get('exact', False)))
+            return 200, await self.batchers['render'].submit(key, {})
+        return 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+
+    async def serve(self, reader, writer):
+        try:
+            line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                header = (await reader.readline()).decode('latin-1')
+                if header in ('\r\n', '\n', ''):
+                    break
+                name, _, value = header.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            data = await reader.readexactly(int(headers.get('content-length', 0)))
+            if len(line) < 2:
+                status, out = 400, {'error': 'bad request'}
+            else:
+                try:
+                    body = json.loads(data.decode('utf-8')) if data.strip() else {}
+                    status, out = await self.handle(line[0].upper(), line[1].split('?')[0].rstrip('/') or '/', body)
+                except (ValueError, KeyError, TypeError) as e:
+                    status, out = 400, {'error': repr(e)}
+                except Exception as e:
+                    status, out = 500, {'error': repr(e)}
+            content = json.dumps(out, ensure_ascii=False, default=str).encode('utf-8')
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                    status, {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}.get(status, 'Error'),
+                    len(content)).encode('latin-1') + content)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+        """
+        Serve on host:port, or on the Unix socket path if given, until
+        cancelled.
+        """
+        if path is not None:
+            server = await asyncio.start_unix_server(self.serve, path=path)
+        else:
+            server = await asyncio.start_server(self.serve, host, port)
+        watcher = asyncio.ensure_future(self.watch()) if self.poll else None
+        print('serving on {}'.format(path if path is not None else '{}:{}'.format(host, port)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self.executor.shutdown(wait=False)
+
+def ids(siteids):
+    # 井號 in string, None for all sites
+    return None if siteids is None else [str(_) for _ in siteids]
+
+def union(siteids):
+    if any(_ is None for _ in siteids):
+        return None
+    return sorted(set(_ for s in siteids for _ in s))
+
+def pick(df, siteids):
+    return df if siteids is None else df[df['井號'].astype(str).isin(siteids)]
+
+def records(df):
+    return json.loads(df.to_json(orient='records', date_format='iso', force_ascii=False))
+
+def query(endpoint, payload=None, host='127.0.0.1', port=8765, timeout=600):
+    """
+    Send a request to the service and output the rows as a
+    pd.DataFrame (or the dict for health, render and reload).
+    """
+    from urllib.request import Request, urlopen
+
+    url = 'http://{}:{}/{}'.format(host, port, endpoint.strip('/'))
+    if payload is None and endpoint.strip('/') == 'health':
+        request = Request(url)
+    else:
+        request = Request(url, data=json.dumps(payload or {}, ensure_ascii=False).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        out = json.loads(response.read().decode('utf-8'))
+    if 'rows' in out:
+        return pd.DataFrame(out['rows'])
+    return out
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve the screening with the data kept in memory.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--path', help='serve on this Unix socket instead')
+    parser.add_argument('--store', default='data/database_ZAF_wl.hd5')
+    parser.add_argument('--ep', default='data/wl_EP_20211107.csv')
+    parser.add_argument('--wa', default='data/database_ZAF_wa_merged_20211031.xlsx')
+    parser.add_argument('--std', default='data/stds_and_cols.xlsx')
+    parser.add_argument('--output', default='results/')
+    parser.add_argument('--cache', default='data/cache/')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--poll', type=float, default=5, help='seconds between checking the files, 0 to disable')
+    args = parser.parse_args()
+
+    service = Service(store_dir=args.store, ep_dir=args.ep, wa_dir=args.wa, excel_dir=args.std,
+        output_dir=args.output, cache_dir=args.cache, threads=args.threads, poll=args.poll)
+    try:
+        asyncio.run(service.start(args.host, args.port, args.path))
+    except KeyboardInterrupt:
+        pass
@@ -3,9 +3,13 @@ This module is built for visualizing results.
 To plot the figures with Traditional Chinese properly, 
 It's recommended to go through install_chinese_font.ipynb first.
 """
+import os
+import json
+from collections import deque, OrderedDict
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from instrument import Instrument
 
 plt.style.use(['seaborn-colorblind'])
 plt.rcParams['figure.dpi'] = 200
@@ -13,20 +17,394 @@ plt.rcParams['savefig.dpi'] = 200
 plt.rcParams['savefig.bbox'] = 'tight'
 plt.rcParams['font.sans-serif'] = ['Taipei Sans TC Beta']
 
+def read_ep(ep_dir):
+    """
+    Read the EP (percentiles of water level) csv with 井號 in string.
+    """
+    ep_df = pd.read_csv(ep_dir)
+    ep_df['井號'] = ep_df['井號'].astype(str)
+    return ep_df
+
+def read_wa(wa_dir):
+    """
+    Read the water quality Excel with 井號 in string and 日期 (the 
+    date of 日期時間).
+    """
+    wa_df = pd.read_excel(wa_dir, parse_dates=['日期時間'])
+    wa_df['日期'] = wa_df['日期時間'].dt.normalize()
+    wa_df['井號'] = wa_df['井號'].astype(str)
+    return wa_df
+
+def read_std(excel_dir, excel_cols):
+    """
+    Read the columns (excel_cols) of the standards Excel.
+    """
+    return pd.read_excel(excel_dir, usecols=excel_cols)
+
+def frame_version(df):
+    """
+    A hash (hex) of the content of a pd.DataFrame (without the index),
+    used as the version of a dataset.
+    """
+    import hashlib
+
+    h = hashlib.sha1('|'.join(str(_) for _ in df.columns).encode('utf-8'))
+    for col in df.columns:
+        values = df[col]
+        if values.dtype.kind not in 'biufcmM':
+            # hashing the repeated strings is slow, hash the codes and 
+            # the unique ones instead
+            codes, uniques = pd.factorize(values)
+            h.update(codes.tobytes())
+            h.update(pd.util.hash_array(np.asarray(uniques, dtype=object)).tobytes())
+        else:
+            h.update(pd.util.hash_pandas_object(values, index=False).values.tobytes())
+    return h.hexdigest()
+
+class SummaryCache():
+    """
+    A least-recently-used cache of the per-site summaries, keeping at
+    most maxsize entries. The keys start with the version of the 
+    dataset, so the summaries of a changed dataset are never reused.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
 class Waterlvl():
     """
     This a class to select sites that are having water level higher 
     than the chosen criteria. 
     """
 
+    # the EP columns (percentiles) used by each criteria, depending on
+    # the trend of the water level
+    criterias = {
+        'decreasing': {
+            '安全': '75',
+            '下限': '25',
+            '嚴重': '10'
+        },
+        'increasing': {
+            '安全': '85',
+            '下限': '35',
+            '嚴重': '20'
+        } 
+    }
+
     def __init__(
         self,
-        ep_dir = 'data/wl_EP_20211107.csv'
+        ep_dir = 'data/wl_EP_20211107.csv',
+        cache_dir = 'data/cache/',
+        cache_size = 8,
+        instrument = None
+    ):
+        self.ep_dir = ep_dir
+        self.cache_dir = cache_dir
+        # the stages are recorded by instrument (see instrument.py) 
+        self.instrument = Instrument(enabled=False) if instrument is None else instrument
+        # the summaries (trend, most recent data and EP) of the sites of
+        # the recent datasets, so MarkbyEP() with another criteria only
+        # compares the thresholds
+        self.summaries = SummaryCache(cache_size)
+        self.ep_df = None
+        self.reload()
+
+    def reload(self):
+        """
+        Load the EP file (again). The cached summaries are cleared if 
+        the EP is changed. The output is True if it's changed.
+        """
+        import datacache
+
+        # the parsed file is cached in cache_dir (None to disable)
+        with self.instrument.stage('read_ep') as record:
+            ep_df = datacache.load(self.ep_dir, read_ep, cache_dir=self.cache_dir)
+            record['rows'] = len(ep_df)
+        if self.ep_df is not None and ep_df.equals(self.ep_df):
+            return False
+        self.set_EP(ep_df)
+        return True
+
+    @classmethod
+    def from_frame(cls, ep_df, cache_size=8, instrument=None):
+        """
+        Create a Waterlvl from an EP pd.DataFrame (like the output of 
+        read_ep()) instead of the file, e.g. for the synthetic data in
+        benchmark.py. reload() is not available.
+        """
+        select = cls.__new__(cls)
+        select.ep_dir, select.cache_dir = None, None
+        select.instrument = Instrument(enabled=False) if instrument is None else instrument
+        select.summaries = SummaryCache(cache_size)
+        select.set_EP(ep_df)
+        return select
+
+    def set_EP(self, ep_df):
+        """
+        Use ep_df as the EP, and clear the cached summaries.
+        """
+        self.ep_df = ep_df
+        # sorted by site and month, so the first row of a (井號, 月) pair
+        # is the same one the loop picks up, and the earlier month comes
+        # first when two months are equally close
+        self.ep_idx = self.ep_df.sort_values(['井號', '月'], kind='mergesort')
+        self.ep_idx = self.ep_idx.drop_duplicates(['井號', '月']).reset_index(drop=True)
+        self.summaries.clear()
+
+    def summarize(self, df):
+        """
+        Summarize the water level of each site in one pass. df is 
+        the same as the input of MarkbyEP.
+        The output is a pd.DataFrame indexed by 井號 (in the order 
+        of appearance after sorting by 日期時間) containing the most
+        recent data of each site and the least-squares sums of 
+        水面至井口深度 against the measurement order: _n (amount),
+        _sy (sum of y) and _sxy (sum of x*y, x counting from 0).
+        """
+        # a stable sort keeps the order of the measurements at the same time
+        order = np.argsort(df['日期時間'].values, kind='mergesort')
+        codes, siteids = pd.factorize(df['井號'].values[order])
+        n = np.bincount(codes, minlength=len(siteids))
+        # group the sorted measurements by site, still in time order
+        grp = np.argsort(codes, kind='mergesort')
+        ends = np.cumsum(n)
+        # the order of each measurement in its site, the x of polyfit
+        x = np.empty(len(codes))
+        x[grp] = np.arange(len(codes)) - np.repeat(ends - n, n)
+        y = df['水面至井口深度'].values[order].astype(float)
+        out_df = df.iloc[order[grp[ends - 1]]].copy()
+        out_df['_n'] = n
+        out_df['_sy'] = np.bincount(codes, weights=y, minlength=len(siteids))
+        out_df['_sxy'] = np.bincount(codes, weights=x*y, minlength=len(siteids))
+        out_df.index = siteids
+        return out_df
+
+    def slope(self, summary):
+        """
+        The slope of the linear fit of each site in the output of 
+        summarize(), which is the same as np.polyfit(range(n), y, 1)[0].
+        A site having only one measurement is regarded as flat.
+        """
+        n = summary['_n'].values.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = (summary['_sxy'].values - (n-1)/2*summary['_sy'].values) / (n*(n**2-1)/12)
+        p[n < 2] = 0
+        return p
+
+    def match_EP(self, summary):
+        """
+        Find the EP row of the month of the most recent data of each
+        site in the output of summarize(). If there is no month EP in
+        database, the closet month is used and the earlier one is 
+        chosen when there are two closet months. Sites not in ep_df
+        get NaN.
+        """
+        X = pd.DataFrame({'井號': summary.index.values, '_mon': summary['月'].values, 
+            '_order': range(len(summary))})
+        X = X.merge(self.ep_idx, on='井號', how='left')
+        X['_dist'] = (X['月'] - X['_mon'])**2
+        # ep_idx is already sorted by month so the earlier month wins the tie
+        X = X.sort_values(['_order', '_dist'], kind='mergesort').drop_duplicates('_order')
+        return X.set_index('井號')
+
+    def str_siteids(self, df):
+        """
+        Convert 井號 of df to string in place.
+        """
+        if pd.api.types.infer_dtype(df['井號'], skipna=False) == 'string':
+            return
+        # only the unique ids need to be converted
+        codes, siteids = pd.factorize(df['井號'])
+        if (codes < 0).any():
+            df['井號'] = df['井號'].astype(str)
+        else:
+            df['井號'] = siteids.astype(str)[codes]
+
+    def trend(self, summary):
+        """
+        Add the slope (_slope) and the EP columns of the matched month
+        (_EP10, _EP20, ...) to the output of summarize(), which are all
+        MarkbyEP() needs besides the criteria.
+        """
+        ep = self.match_EP(summary)
+        summary = summary.copy()
+        summary['_slope'] = self.slope(summary)
+        for col in self.ep_columns():
+            summary['_EP' + col] = ep[col].values
+        return summary
+
+    def ep_columns(self):
+        return sorted(set(v for trend in self.criterias.values() for v in trend.values()))
+
+    def mark_summary(self, summary, criteria):
+        """
+        The output of MarkbyEP() from the output of summarize() or 
+        trend().
+        """
+        criterias = self.criterias
+        if '_slope' not in summary.columns:
+            summary = self.trend(summary)
+        # the water level is at a decreasing (or flat) or increasing trend
+        lim = np.where(summary['_slope'].values <= 0, 
+            summary['_EP' + criterias['decreasing'][criteria]].values, 
+            summary['_EP' + criterias['increasing'][criteria]].values)
+        internal = ['_n', '_sy', '_sxy', '_slope'] + ['_EP' + _ for _ in self.ep_columns()]
+        out_df = summary.drop(internal, axis=1).set_index('日期時間')
+        out_df.index.name = None
+        out_df['wl_check'] = summary['水面至井口深度'].values > lim
+        return out_df
+
+    def merge_summary(self, s1, s2):
+        """
+        Merge two outputs of summarize(), where s2 is summarized from
+        the measurements after those of s1, as if they are summarized
+        at once. The x of s2 continues from the amount in s1.
+        """
+        if s1 is None:
+            return s2
+        n1 = s1['_n'].reindex(s2.index, fill_value=0).values
+        s2 = s2.copy()
+        s2['_sxy'] = s2['_sxy'].values + s1['_sxy'].reindex(s2.index, fill_value=0).values + n1*s2['_sy'].values
+        s2['_sy'] = s2['_sy'].values + s1['_sy'].reindex(s2.index, fill_value=0).values
+        s2['_n'] = s2['_n'].values + n1
+        # the sites keep the order of their first appearance
+        order = s1.index.append(s2.index[~s2.index.isin(s1.index)])
+        return pd.concat([s1[~s1.index.isin(s2.index)], s2]).reindex(order)
+
+    def read(
+        self,
+        store_dir = 'data/database_ZAF_wl.hd5',
+        start = None,
+        end = None,
+        siteids = None,
+        key = 'wl',
+        columns = None,
+        window = None
     ):
-        self.ep_df = pd.read_csv(ep_dir)
-        self.ep_df['井號'] = self.ep_df['井號'].astype(str)
+        """
+        Read the water level between start and end (end excluded) of
+        the sites (井號) in siteids from the HDF store in table format
+        (see database.py), the whole history and all sites if None. 
+        The conditions are pushed down to the store, so only the 
+        matching rows are read. key can be a table or the group of 
+        the yearly tables (wl/yYYYY) built by database.Builder.
+        If window is given (e.g. '7D'), the output is a generator of 
+        the data of the consecutive time windows instead, which can be
+        passed to MarkbyEP() directly.
+        """
+        if window is None:
+            with self.instrument.stage('read', start=start, end=end) as record:
+                df = self.select(store_dir, key, start, end, siteids, columns)
+                record['rows'] = len(df)
+            return df
+        if start is None or end is None:
+            # the whole history of the tables
+            with pd.HDFStore(store_dir, mode='r') as store:
+                spans = [self.span(store, k) for k in self.tables(store, key, start, end)]
+            spans = [_ for _ in spans if _ is not None]
+            if len(spans) == 0:
+                return iter([])
+            start = min(_[0] for _ in spans) if start is None else start
+            end = max(_[1] for _ in spans) + pd.Timedelta(1, 's') if end is None else end
+        return (self.select(store_dir, key, lo, hi, siteids, columns) 
+            for lo, hi in self.windows(start, end, window))
+
+    def span(self, store, key):
+        """
+        The first and last 日期時間 of the table of key, or None if it's
+        empty. They are found by the completely sorted index of 
+        日期時間 (see database.index()) without reading the column, or
+        by going through the column in chunks if it's not indexed.
+        """
+        table = store.get_storer(key).table
+        if table.nrows == 0:
+            return None
+        col = table.colinstances.get('日期時間')
+        if col is not None and col.is_indexed and col.index.is_csi:
+            coords = np.concatenate([col.index.read_indices(0, 1), 
+                col.index.read_indices(table.nrows - 1, table.nrows)])
+            dates = store.select(key, where=coords, columns=['日期時間'])['日期時間']
+            return dates.min(), dates.max()
+        lo, hi = None, None
+        for i in range(0, table.nrows, 1000000):
+            dates = store.select_column(key, '日期時間', start=i, stop=i + 1000000)
+            lo = dates.min() if lo is None else min(lo, dates.min())
+            hi = dates.max() if hi is None else max(hi, dates.max())
+        return lo, hi
+
+    def tables(self, store, key, start=None, end=None):
+        """
+        The tables of key in the store, only the yearly ones between 
+        start and end if key is a group.
+        """
+        key = '/' + key.strip('/')
+        if key in store.keys():
+            return [key]
+        years = sorted(k for k in store.keys() if k.startswith(key + '/y'))
+        if start is not None:
+            years = [k for k in years if int(k[-4:]) >= pd.Timestamp(start).year]
+        if end is not None:
+            years = [k for k in years if int(k[-4:]) <= pd.Timestamp(end).year]
+        return years
+
+    def windows(self, start, end, window):
+        """
+        The consecutive time windows [lo, hi) of length window from 
+        start to end.
+        """
+        bounds = list(pd.date_range(start, end, freq=window))
+        if bounds[-1] < pd.Timestamp(end):
+            bounds.append(pd.Timestamp(end))
+        return zip(bounds[:-1], bounds[1:])
+
+    def select(self, store_dir, key, start, end, siteids, columns):
+        """
+        The rows between start and end of siteids in the tables of key.
+        """
+        terms = []
+        if start is not None:
+            start = pd.Timestamp(start)
+            terms.append('日期時間 >= start')
+        if end is not None:
+            end = pd.Timestamp(end)
+            terms.append('日期時間 < end')
+        out = []
+        with pd.HDFStore(store_dir, mode='r') as store:
+            for k in self.tables(store, key, start, end):
+                where = list(terms)
+                if siteids is not None:
+                    # 井號 could be stored as numbers in the older stores
+                    if store.select(k, stop=0)['井號'].dtype.kind in 'iu':
+                        siteids = [int(_) for _ in siteids]
+                    else:
+                        siteids = [str(_) for _ in siteids]
+                    where.append('井號 in siteids')
+                out.append(store.select(k, where=' & '.join(where) or None, columns=columns))
+        if len(out) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(out, ignore_index=True)
 
-    def MarkbyEP(self, df, criteria='安全'):
+    def MarkbyEP(self, df, criteria='安全', vectorized=True, version=None):
         """
         This a function to mark sites that are having water level 
         higher than the chosen criteria. 
@@ -36,26 +414,56 @@ class Waterlvl():
         The output is a pd.DataFrame consisting the information (taken
         from the most recent data of each site) and the checked result
         of the input sites.
+        By default, the sites are computed all at once with the sums
+        from summarize(). Set vectorized to False to go through the 
+        sites one by one with np.polyfit.
+        df can also be an iterable of pd.DataFrame in time order (e.g.
+        read() with window), which are summarized one by one, so only
+        one of them is in the memory at a time.
+        The summaries of df are cached by the version of df, so calling
+        again with another criteria doesn't compute them again. Pass 
+        version (any string) to skip hashing df for the version.
         """
-        criterias = {
-            'decreasing': {
-                '安全': '75',
-                '下限': '25',
-                '嚴重': '10'
-            },
-            'increasing': {
-                '安全': '85',
-                '下限': '35',
-                '嚴重': '20'
-            } 
-        }
-        df['井號'] = df['井號'].astype(str)
+        criterias = self.criterias
+        if not isinstance(df, pd.DataFrame):
+            if criteria not in criterias['decreasing'].keys():
+                print('Please set the criteria in the list of {}'.format(criterias['decreasing'].keys()))
+                return
+            summary, columns = None, ['井號', '水面至井口深度']
+            for X in df:
+                columns = [_ for _ in X.columns if _ != '日期時間']
+                if len(X) > 0:
+                    with self.instrument.stage('MarkbyEP.summarize', rows=len(X)):
+                        self.str_siteids(X)
+                        summary = self.merge_summary(summary, self.summarize(X))
+            if summary is None:
+                # no data in any of them
+                return pd.DataFrame(columns=columns + ['wl_check'], index=pd.DatetimeIndex([]))
+            with self.instrument.stage('MarkbyEP.mark', rows=len(summary)):
+                return self.mark_summary(summary, criteria)
+        self.str_siteids(df)
         out_df = pd.DataFrame()
         check_list = []
-        if criteria in criterias['decreasing'].keys():
+        if criteria in criterias['decreasing'].keys() and vectorized:
+            if version is None:
+                with self.instrument.stage('MarkbyEP.version', rows=len(df)):
+                    version = frame_version(df)
+            summary = self.summaries.get(version)
+            self.instrument.count('MarkbyEP.cache', hit=summary is not None)
+            if summary is None:
+                with self.instrument.stage('MarkbyEP.summarize', rows=len(df)):
+                    summary = self.summarize(df)
+                with self.instrument.stage('MarkbyEP.trend', rows=len(summary)):
+                    summary = self.trend(summary)
+                self.summaries.put(version, summary)
+            with self.instrument.stage('MarkbyEP.mark', rows=len(summary)):
+                return self.mark_summary(summary, criteria)
+        elif criteria in criterias['decreasing'].keys():
             df = df.set_index('日期時間').sort_values('日期時間')
             for siteid in df['井號'].unique():
-                X = df[df['井號'] == siteid].copy()
+                with self.instrument.stage('MarkbyEP.select', siteid=siteid) as record:
+                    X = df[df['井號'] == siteid].copy()
+                    record['rows'] = len(X)
                 # take the most recent data as the out put
                 out_df = pd.concat([out_df, X.iloc[-1, :]], join='outer', axis=1)
                 mask = (self.ep_df['月'] == X['月'].values[-1]) & (self.ep_df['井號'] == X['井號'].values[-1])
@@ -69,7 +477,8 @@ class Waterlvl():
                     mask = (self.ep_df['月'] == mon_alt) & (self.ep_df['井號'] == X['井號'].values[-1])
 
                 # find the slope of the measurements
-                p = np.polyfit(range(len(X)), X['水面至井口深度'], 1)
+                with self.instrument.stage('MarkbyEP.polyfit', siteid=siteid, rows=len(X)):
+                    p = np.polyfit(range(len(X)), X['水面至井口深度'], 1)
                 
                 # the water level is at a decreasing or flat trend
                 if p[0] <= 0:
@@ -89,6 +498,262 @@ class Waterlvl():
         else:
             print('Please set the criteria in the list of {}'.format(criterias['decreasing'].keys()))        
 
+class WaterlvlMonitor():
+    """
+    This is a class to mark the sites by EP as MarkbyEP() does, but 
+    the new measurements are fed one by one for the alerting. Each site
+    keeps the sums of the linear fit (n, x, y, xy, xx) and the most
+    recent data, so a measurement is updated in constant time. The 
+    latest measurement is at x = 0 and the earlier ones are shifted 
+    backward, so the sums stay small.
+    By default, the fit goes through the whole history, which is the 
+    same as MarkbyEP(). Set window to fit only the latest window 
+    measurements, or alpha to weight the measurements exponentially
+    (the weight of a measurement decays by 1-alpha each time), but
+    not both.
+    The state is saved in the json of state_dir, if given, and loaded
+    when the monitor is created again.
+    """
+
+    def __init__(
+        self,
+        ep_dir = 'data/wl_EP_20211107.csv',
+        cache_dir = 'data/cache/',
+        state_dir = None,
+        window = None,
+        alpha = None
+    ):
+        if window is not None and alpha is not None:
+            # a dropped measurement can't be taken out of decayed sums
+            raise ValueError('Please set only one of window and alpha.')
+        self.window = window
+        self.alpha = alpha
+        self.state_dir = state_dir
+        self.criterias = Waterlvl.criterias
+        self.ep = self.index_EP(Waterlvl(ep_dir=ep_dir, cache_dir=cache_dir))
+        self.wells = {}
+        if state_dir is not None and os.path.isfile(state_dir):
+            self.load(state_dir)
+
+    def index_EP(self, select):
+        """
+        The EP columns of each site and month (1-12) used by the 
+        criterias, with the closet month as MarkbyEP() does.
+        """
+        sites = select.ep_idx['井號'].unique()
+        summary = pd.DataFrame({'月': np.tile(np.arange(1, 13), len(sites))}, 
+            index=np.repeat(sites, 12))
+        ep = select.match_EP(summary)
+        cols = select.ep_columns()
+        keys = zip(ep.index, ep['_mon'])
+        return dict(zip(keys, ep[cols].to_dict('records')))
+
+    def update(self, siteid, time, depth, month=None):
+        """
+        Feed a measurement (水面至井口深度) of the site at time. The 
+        measurements older than the most recent one of the site are
+        ignored, and so are the missing ones (NaN, e.g. 缺測 in the 
+        store of database.Builder), which would stay in the sums. The
+        output is a dict of the criterias whose wl_check is changed, 
+        with the new wl_check.
+        """
+        if pd.isna(depth):
+            return {}
+        siteid = str(siteid)
+        time = pd.Timestamp(time)
+        if month is None:
+            month = time.month
+        well = self.wells.get(siteid)
+        if well is None:
+            well = {'n': 0., 'sx': 0., 'sy': 0., 'sxy': 0., 'sxx': 0., 
+                'ys': deque(), 'time': None, 'depth': None, 'month': None, 'check': {}}
+            self.wells[siteid] = well
+        elif time < pd.Timestamp(well['time']):
+            return {}
+        depth = float(depth)
+        decay = 1 if self.alpha is None else 1 - self.alpha
+        n, sx, sy, sxy, sxx = well['n'], well['sx'], well['sy'], well['sxy'], well['sxx']
+        # shift the earlier measurements to x - 1, with the decay
+        sxx = decay * (sxx - 2*sx + n)
+        sxy = decay * (sxy - sy)
+        sx = decay * (sx - n)
+        sy = decay * sy
+        n = decay * n
+        if self.window is not None:
+            well['ys'].append(depth)
+            if len(well['ys']) > self.window:
+                # drop the oldest one, at x = -window now
+                y, x = well['ys'].popleft(), -self.window
+                n, sx, sy, sxy, sxx = n - 1, sx - x, sy - y, sxy - x*y, sxx - x*x
+        # the new measurement is at x = 0
+        well['n'], well['sx'], well['sy'], well['sxy'], well['sxx'] = n + 1, sx, sy + depth, sxy, sxx
+        well['time'], well['depth'], well['month'] = time.isoformat(), depth, int(month)
+
+        changes = {}
+        for criteria, check in self.check(siteid).items():
+            if well['check'].get(criteria) != check:
+                changes[criteria] = check
+                well['check'][criteria] = check
+        return changes
+
+    def slope(self, siteid):
+        """
+        The slope of the linear fit of the site. A site having only 
+        one measurement is regarded as flat.
+        """
+        well = self.wells[siteid]
+        n, sx, sy, sxy, sxx = well['n'], well['sx'], well['sy'], well['sxy'], well['sxx']
+        denom = n*sxx - sx**2
+        # it's 0 for a single measurement, up to the float error
+        if denom <= 1e-12:
+            return 0.
+        return (n*sxy - sx*sy) / denom
+
+    def check(self, siteid):
+        """
+        The wl_check of each criteria of the site. Sites not in the EP 
+        file are always False, as MarkbyEP() does.
+        """
+        well = self.wells[siteid]
+        ep = self.ep.get((siteid, well['month']))
+        trend = 'decreasing' if self.slope(siteid) <= 0 else 'increasing'
+        checks = {}
+        for criteria, col in self.criterias[trend].items():
+            checks[criteria] = ep is not None and bool(well['depth'] > ep[col])
+        return checks
+
+    def update_df(self, df):
+        """
+        Feed the measurements in a pd.DataFrame with columns of 日期時間,
+        井號, 水面至井口深度 (and 月), in the order of 日期時間.
+        The output is a pd.DataFrame of the changes of wl_check with 
+        columns of 井號, 日期時間, criteria, wl_check. The state is saved
+        afterwards if state_dir is given.
+        """
+        order = np.argsort(df['日期時間'].values, kind='mergesort')
+        months = df['月'].values[order] if '月' in df.columns else [None] * len(df)
+        rows = []
+        for siteid, time, depth, month in zip(df['井號'].values[order], 
+            df['日期時間'].values[order], df['水面至井口深度'].values[order], months):
+            for criteria, check in self.update(siteid, time, depth, month).items():
+                rows.append([str(siteid), pd.Timestamp(time), criteria, check])
+        if self.state_dir is not None:
+            self.save()
+        return pd.DataFrame(rows, columns=['井號', '日期時間', 'criteria', 'wl_check'])
+
+    def status(self):
+        """
+        The most recent data and wl_check of each criteria of the sites.
+        """
+        return pd.DataFrame([
+            dict(井號=siteid, 日期時間=pd.Timestamp(well['time']), 水面至井口深度=well['depth'], 
+                月=well['month'], **well['check'])
+            for siteid, well in self.wells.items()
+        ])
+
+    def save(self, state_dir=None):
+        import datacache
+
+        if state_dir is None:
+            state_dir = self.state_dir
+        wells = {siteid: dict(well, ys=list(well['ys'])) for siteid, well in self.wells.items()}
+        state = {'window': self.window, 'alpha': self.alpha, 'wells': wells}
+        datacache.write_json(state_dir, state, indent=None)
+
+    def load(self, state_dir):
+        with open(state_dir, encoding='utf-8') as f:
+            state = json.load(f)
+        if state['window'] != self.window or state['alpha'] != self.alpha:
+            print('The state in {} is for window={}, alpha={}, start over.'.format(
+                state_dir, state['window'], state['alpha']))
+            return
+        self.wells = {siteid: dict(well, ys=deque(well['ys'])) for siteid, well in state['wells'].items()}
+
+def downsample(x, y, max_points, keep=None):
+    """
+    The indices (in the order of x) of the points of a long series to
+    draw, about max_points of them, keeping its shape: x is split into
+    max_points/2 equal buckets and the lowest and highest y of each 
+    bucket are kept, as well as the first and last points. keep is a
+    boolean array marking the points kept anyway. NaN y are dropped
+    since they're not drawn. x and y are numeric arrays (e.g. 
+    mdates.date2num of the dates), and it also works for the hourly
+    water level in the notebooks.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    order = np.argsort(x, kind='mergesort')
+    valid = ~np.isnan(y[order])
+    if keep is None:
+        keep = np.zeros(len(x), dtype=bool)
+    keep = np.asarray(keep, dtype=bool)[order]
+    if valid.sum() <= max_points:
+        return order[valid | keep]
+    buckets = max(max_points // 2, 1)
+    xs = x[order][valid]
+    span = xs[-1] - xs[0]
+    if span > 0:
+        bucket = np.minimum(((xs - xs[0]) / span * buckets).astype(np.int64), buckets - 1)
+    else:
+        bucket = np.zeros(len(xs), dtype=np.int64)
+    # sorted by y in each bucket, the first one is the lowest
+    by_y = np.lexsort((y[order][valid], bucket))
+    starts = np.flatnonzero(np.diff(np.append(-1, bucket[by_y])))
+    ends = np.append(starts[1:], len(by_y)) - 1
+    picked = np.zeros(len(xs), dtype=bool)
+    picked[by_y[starts]] = True
+    picked[by_y[ends]] = True
+    picked[[0, -1]] = True
+    chosen = np.zeros(len(x), dtype=bool)
+    chosen[np.flatnonzero(valid)[picked]] = True
+    return order[chosen | keep]
+
+def crossings(x, passed):
+    """
+    Mark the points next to a change between passed and not passed 
+    (符合/未符合), in the order of x.
+    """
+    passed = np.asarray(passed, dtype=bool)
+    order = np.argsort(np.asarray(x, dtype=float), kind='mergesort')
+    change = np.diff(passed[order].astype(np.int8)) != 0
+    out = np.zeros(len(passed), dtype=bool)
+    out[order[:-1][change]] = True
+    out[order[1:][change]] = True
+    return out
+
+def plot_index(ax, dates, values, passed, max_points=None, exact=False):
+    """
+    The indices of the points to draw on ax, in the order of dates.
+    The passed and not passed points are downsampled separately by 
+    downsample(), sharing max_points by their amounts, so both of them
+    keep their shapes, and the threshold crossings are kept. max_points
+    is twice the pixel width of ax by default. Set exact to True to 
+    draw all the points.
+    """
+    import matplotlib.dates as mdates
+
+    if exact:
+        return np.arange(len(values))
+    if max_points is None:
+        max_points = 2 * int(ax.get_window_extent().width)
+    x = mdates.date2num(dates)
+    values = np.asarray(values, dtype=float)
+    passed = np.asarray(passed, dtype=bool)
+    # NaN is not passed, but it's not drawn either
+    valid = ~np.isnan(values)
+    keep = np.zeros(len(values), dtype=bool)
+    keep[valid] = crossings(x[valid], passed[valid])
+    shown = []
+    for group in [valid & passed, valid & ~passed]:
+        members = np.flatnonzero(group)
+        if len(members) > 0:
+            budget = max(int(max_points * len(members) / valid.sum()), 2)
+            shown.append(members[downsample(x[members], values[members], budget, keep=keep[members])])
+    if len(shown) == 0:
+        return np.array([], dtype=np.int64)
+    shown = np.concatenate(shown)
+    return shown[np.argsort(x[shown], kind='mergesort')]
+
 class Waterquality():
     """
     This is a class to plot and filter the historical water quality by 
@@ -111,55 +776,298 @@ class Waterquality():
         '地下水污染監測標準第二類', '地下水污染管制標準第一類', 
         '地下水污染管制標準第二類', '灌溉用水水質標準', 
         '再生水用於工業用途水質基礎建議值一', 
-        '再生水用於工業用途水質基礎建議值二']
+        '再生水用於工業用途水質基礎建議值二'],
+        cache_dir = 'data/cache/',
+        cache_size = 256,
+        instrument = None
     ):
-        self.wa_df = pd.read_excel(wa_dir, parse_dates=['日期時間'])
-        self.wa_df['日期'] = pd.to_datetime([_.strftime('%Y-%m-%d') for _ in self.wa_df['日期時間']])
-        self.wa_df['井號'] = self.wa_df['井號'].astype(str)
-        self.std_df = pd.read_excel(excel_dir, usecols=excel_cols)
+        # the stages are recorded by instrument (see instrument.py) 
+        self.instrument = Instrument(enabled=False) if instrument is None else instrument
+        self.wa_dir = wa_dir
+        self.excel_dir = excel_dir
+        self.excel_cols = excel_cols
+        self.cache_dir = cache_dir
         self.output_dir = output_dir
         self.std_names = excel_cols[2:]
+        # the summaries of the recently used sites, see site_summary()
+        self.summaries = SummaryCache(cache_size)
+        self.version = None
+        self.reload()
+
+    def reload(self):
+        """
+        Load the water quality and standards files (again). The indexes
+        and the cached summaries are rebuilt if any of them is changed.
+        The output is True if it's changed.
+        """
+        import datacache
+
+        # the parsed files are cached in cache_dir (None to disable)
+        with self.instrument.stage('read_wa') as record:
+            wa_df = datacache.load(self.wa_dir, read_wa, cache_dir=self.cache_dir)
+            record['rows'] = len(wa_df)
+        with self.instrument.stage('read_std') as record:
+            std_df = datacache.load(self.excel_dir, read_std, cache_dir=self.cache_dir, excel_cols=self.excel_cols)
+            record['rows'] = len(std_df)
+        version = frame_version(wa_df) + frame_version(std_df.astype(str))
+        if version == self.version:
+            return False
+        self.set_data(wa_df, std_df, version)
+        return True
+
+    @classmethod
+    def from_frames(
+        cls,
+        wa_df,
+        std_df,
+        output_dir = 'results/',
+        std_names = None,
+        cache_size = 256,
+        instrument = None
+    ):
+        """
+        Create a Waterquality from pd.DataFrame (like the outputs of 
+        read_wa() and read_std()) instead of the files, e.g. for the 
+        synthetic data in benchmark.py. std_names are the standard 
+        columns of std_df, the ones after 項目 and 單位 by default.
+        reload() is not available.
+        """
+        select = cls.__new__(cls)
+        select.instrument = Instrument(enabled=False) if instrument is None else instrument
+        select.wa_dir, select.excel_dir, select.cache_dir = None, None, None
+        select.output_dir = output_dir
+        if std_names is None:
+            std_names = [_ for _ in std_df.columns if _ not in ['項目', '單位']]
+        select.excel_cols = ['項目', '單位'] + list(std_names)
+        select.std_names = list(std_names)
+        select.summaries = SummaryCache(cache_size)
+        select.set_data(wa_df, std_df, frame_version(wa_df) + frame_version(std_df.astype(str)))
+        return select
+
+    def set_data(self, wa_df, std_df, version):
+        """
+        Use wa_df and std_df as the data, and rebuild the indexes and 
+        the cached summaries.
+        """
+        self.wa_df, self.std_df, self.version = wa_df, std_df, version
+        with self.instrument.stage('index', rows=len(wa_df)):
+            self.compile_STD()
+            self.index_sites()
+        self.rate_df = None
+        self.summaries.clear()
+
+    def compile_STD(self):
+        """
+        Compile the standards in std_df into numeric bounds once, which
+        are pd.DataFrame (項目 x std_name) of the lower (std_lo) and 
+        upper (std_up) limits. NaN means there is no limit. There are 
+        three different scenarios about the standard value: 
+        氫離子濃度指數 is a range 'lo-up' including both ends, 溶氧量
+        is a lower limit and the rest are upper limits. std_closed
+        marks the analytes whose limits are included.
+        """
+        self.std_idx = self.std_df.set_index('項目')
+        X = self.std_idx[self.std_names]
+        self.std_lo = pd.DataFrame(np.nan, index=X.index, columns=self.std_names)
+        self.std_up = pd.DataFrame(np.nan, index=X.index, columns=self.std_names)
+        for analyte, row in X.iterrows():
+            if analyte == '氫離子濃度指數':
+                lims = row.dropna().astype(str).str.split('-')
+                self.std_lo.loc[analyte, lims.index] = [float(_[0]) for _ in lims]
+                self.std_up.loc[analyte, lims.index] = [float(_[1]) for _ in lims]
+            elif analyte == '溶氧量':
+                self.std_lo.loc[analyte] = pd.to_numeric(row, errors='coerce').values
+            else:
+                self.std_up.loc[analyte] = pd.to_numeric(row, errors='coerce').values
+        self.std_closed = pd.Series(X.index == '氫離子濃度指數', index=X.index)
+
+    def index_sites(self):
+        """
+        Sort wa_df by 井號 (in string, as read_wa() does, keeping the order of the rows in a site) so 
+        each site is a contiguous block of rows, and build the indexes
+        used to select the data of a site without going through wa_df:
+        site_rows: {siteid: slice of the rows in wa_df}
+        site_analytes: pd.DataFrame (siteid x analyte) marking the 
+            analytes having any (non-zero) value in the site, the same
+            as X.any(axis=0) of the site.
+        std_analytes: {std_name: the analytes in wa_df having a limit
+            in the standard, in the column order of wa_df}
+        """
+        # the order of the sort must be the same as np.unique() below
+        self.wa_df = self.wa_df.assign(井號=self.wa_df['井號'].astype(str))
+        self.wa_df = self.wa_df.sort_values('井號', kind='mergesort').reset_index(drop=True)
+        self.siteids, self.site_starts = np.unique(self.wa_df['井號'].values, return_index=True)
+        ends = np.append(self.site_starts[1:], len(self.wa_df))
+        self.site_rows = {
+            str(siteid): slice(start, end) for siteid, start, end in zip(self.siteids, self.site_starts, ends)
+        }
+        # the analytes in both the standards and the water quality dataset
+        analytes = [_ for _ in self.wa_df.columns if _ in self.std_lo.index]
+        V = self.wa_df[analytes].values.astype(float)
+        nonzero = ~np.isnan(V) & (V != 0)
+        self.site_analytes = pd.DataFrame(
+            np.add.reduceat(nonzero, self.site_starts, axis=0) > 0 if len(V) > 0 else nonzero,
+            index=self.siteids, columns=analytes
+        )
+        has_lim = ~self.std_lo.loc[analytes].isna() | ~self.std_up.loc[analytes].isna()
+        self.std_analytes = {
+            std_name: [_ for _ in analytes if has_lim.loc[_, std_name]] for std_name in self.std_names
+        }
+
+    def site_data(self, siteid):
+        """
+        The rows of the siteid (井號) in wa_df, index from 0.
+        """
+        return self.wa_df.iloc[self.site_rows[siteid]].reset_index(drop=True)
+
+    def site_summary(self, siteid):
+        """
+        The summary of the siteid (井號), cached by the version of the 
+        dataset and the siteid. It's a dict of
+        data: the rows of the site in wa_df (see site_data())
+        analytes: {std_name: the analytes of site_std_analytes()}
+        """
+        key = (self.version, siteid)
+        summary = self.summaries.get(key)
+        if summary is None:
+            summary = {
+                'data': self.site_data(siteid),
+                'analytes': {std_name: self.site_std_analytes(siteid, std_name) for std_name in self.std_names},
+            }
+            self.summaries.put(key, summary)
+        return summary
+
+    def site_std_analytes(self, siteid, std_name):
+        """
+        The analytes of the siteid (井號) both having values in the 
+        water quality dataset and limits in the std_name (法規名稱).
+        """
+        has_value = self.site_analytes.loc[siteid]
+        return [_ for _ in self.std_analytes[std_name] if has_value[_]]
+
+    def passed(self, values, analyte, std_name):
+        """
+        Mark the values (pd.Series) of the analyte passing the std_name
+        or not, by the compiled limits of compile_STD(). NaN is False.
+        """
+        lo = np.nan_to_num(self.std_lo.loc[analyte, std_name], nan=-np.inf)
+        up = np.nan_to_num(self.std_up.loc[analyte, std_name], nan=np.inf)
+        if self.std_closed[analyte]:
+            return (values >= lo) & (values <= up)
+        else:
+            return (values > lo) & (values < up)
 
-    def plot(self, siteid, std_name, savefig=False):
+    def pass_rates(self):
+        """
+        Compute the pass rate of every analyte of every site under all 
+        the standards in one pass over wa_df. The pass rate is the 
+        ratio of passed measurements and total amount of values 
+        (exclude None).
+        The values below the detection limit (marked in the columns of
+        {analyte}_censored and {analyte}_MDL by 
+        database.parse_censored_frame()) are lower than the MDL, so
+        they pass an upper limit not lower than the MDL, fail a lower
+        limit not lower than the MDL, and are not counted otherwise
+        since it can't be told.
+        The output is a pd.DataFrame indexed by (井號, 項目) with the 
+        columns of std_names. It is NaN when the analyte is not in the
+        standard or the site has no value (nor non-zero value) of it.
+        The result is kept in rate_df for the later calls.
+        """
+        if self.rate_df is not None:
+            return self.rate_df
+        with self.instrument.stage('pass_rates', rows=len(self.wa_df)):
+            return self._pass_rates()
+
+    def censored(self, analytes):
+        """
+        The censored flags and the MDL (arrays of rows x analytes) of 
+        the analytes in wa_df. They are False and NaN if wa_df has no
+        such columns.
+        """
+        C = np.zeros((len(self.wa_df), len(analytes)), dtype=bool)
+        L = np.full((len(self.wa_df), len(analytes)), np.nan)
+        for i, analyte in enumerate(analytes):
+            if '{}_censored'.format(analyte) in self.wa_df.columns:
+                C[:, i] = self.wa_df['{}_censored'.format(analyte)].fillna(False).values.astype(bool)
+            if '{}_MDL'.format(analyte) in self.wa_df.columns:
+                L[:, i] = pd.to_numeric(self.wa_df['{}_MDL'.format(analyte)], errors='coerce').values
+        return C, L
+
+    def _pass_rates(self):
+        analytes = list(self.site_analytes.columns)
+        V = self.wa_df[analytes].values.astype(float)
+        lo = self.std_lo.loc[analytes].fillna(-np.inf).values
+        up = self.std_up.loc[analytes].fillna(np.inf).values
+        closed = self.std_closed[analytes].values
+        censored = any('{}_censored'.format(_) in self.wa_df.columns for _ in analytes)
+        if censored:
+            C, L = self.censored(analytes)
+        valid = ~np.isnan(V)
+        # the counts of each site (wa_df is sorted by 井號 in 
+        # index_sites()) are summed for one standard at a time, so only
+        # the masks of one standard are in the memory
+        def reduce(mask):
+            return np.add.reduceat(mask, self.site_starts, axis=0, dtype=np.int32)
+        n = len(self.std_names)
+        passed = np.zeros((len(self.siteids), n, len(analytes)), dtype=np.int32)
+        counted = np.zeros((len(self.siteids), n, len(analytes)), dtype=np.int32)
+        counted[:] = reduce(valid)[:, None, :]
+        for i in range(n):
+            above = (V > lo[:, i]) | (closed & (V == lo[:, i]))
+            below = (V < up[:, i]) | (closed & (V == up[:, i]))
+            ok = above & below
+            if censored:
+                # below the detection limit, only the sure ones are counted
+                with np.errstate(invalid='ignore'):
+                    sure_pass = np.isinf(lo[:, i]) & (L <= up[:, i])
+                    sure_fail = L <= lo[:, i]
+                ok = np.where(C, sure_pass, ok)
+                counted[:, i] = reduce(np.where(C, sure_pass | sure_fail, valid))
+            passed[:, i] = reduce(ok)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = passed / counted
+        # applicable: the standard has a limit and the site has the analyte
+        has_lim = (~self.std_lo.loc[analytes].isna() | ~self.std_up.loc[analytes].isna()).values.T
+        rates[~(has_lim[None, :, :] & self.site_analytes[analytes].values[:, None, :])] = np.nan
+        self.rate_df = pd.DataFrame(
+            rates.transpose(0, 2, 1).reshape(-1, len(self.std_names)),
+            index=pd.MultiIndex.from_product([self.siteids, analytes], names=['井號', '項目']),
+            columns=self.std_names
+        )
+        return self.rate_df
+
+    def plot(self, siteid, std_name, savefig=False, max_points=None, exact=False):
         """
         siteid (井號) and std_name (法規名稱) need to be strings.
         Set savefig to True when you wish to output the figures, which
         is in png format (200 dpi).
+        A long series is downsampled to about max_points points (see 
+        plot_index()), keeping the shapes of both the 符合 and 未符合 
+        points and the threshold crossings. Set exact to True to draw all the points.
         """
-        import os
-
-        if (siteid in self.wa_df['井號'].unique()) and (std_name in self.std_names):
-            # collect the analytes having value in the standard (std_name) and '日期'
-            cols = np.hstack([self.std_df.loc[~self.std_df[std_name].isna(), '項目'], '日期'])
+        if (siteid in self.site_rows) and (std_name in self.std_names):
+            summary = self.site_summary(siteid)
             # select the data points of that siteid
-            X = self.wa_df[self.wa_df['井號'] == siteid].reset_index(drop=True)
+            X = summary['data']
             # pick up the site name
             site_name = X['井名'][0]
             # select the analytes both have values in the water quality dataset
             # and in the standard.
-            X = X.loc[:, X.columns.isin(cols)]
-            X = X.loc[:, X.any(axis=0)].copy()
-            #with open('results/error.txt', 'w', encoding='utf-8') as f:
-            #        print(X.columns, file=f)
-            # the last one is '日期'
-            for analyte in X.columns[:-1]:
+            analytes = summary['analytes'][std_name]
+            for analyte in analytes:
                 #with open('results/error.txt', 'a', encoding='utf-8') as f:
                 #    print(analyte, file=f)
-                unit = self.std_df.loc[self.std_df['項目'] == analyte, '單位'].values[0]
-                std_value = self.std_df.loc[self.std_df['項目'] == analyte, std_name].values[0]
-                # there are three different scenarios about the standard value
-                if analyte == '氫離子濃度指數':
-                    lo_lim, up_lim = [float(_) for _ in std_value.split('-')]
-                    mask = (X[analyte] >= lo_lim) & (X[analyte] <= up_lim)
-                elif analyte == '溶氧量':
-                    mask = X[analyte] > std_value
-                else:
-                    mask = X[analyte] < std_value
+                unit = self.std_idx.loc[analyte, '單位']
+                std_value = self.std_idx.loc[analyte, std_name]
+                mask = self.passed(X[analyte], analyte, std_name)
 
                 plt.figure(figsize=(7, 5))
-                plt.plot_date(X.loc[mask, '日期'], X.loc[mask, analyte], 
+                shown = plot_index(plt.gca(), X['日期'], X[analyte], mask, max_points, exact)
+                Y, mask = X.iloc[shown], mask.iloc[shown]
+                plt.plot_date(Y.loc[mask, '日期'], Y.loc[mask, analyte], 
                     c='C0', fmt='o', xdate=True, label='符合')
-                plt.plot_date(X.loc[~mask, '日期'], X.loc[~mask, analyte], 
+                plt.plot_date(Y.loc[~mask, '日期'], Y.loc[~mask, analyte], 
                     c='gray', fmt='^', xdate=True, label='未符合')
                 plt.xlabel('日期')
                 plt.ylabel('{} ({})'.format(analyte, unit))
@@ -175,44 +1083,42 @@ class Waterquality():
                     else:
                         os.mkdir(self.output_dir)
                     plt.savefig('{}{}_{}_{}.png'.format(self.output_dir, siteid, std_name, analyte))
-        elif siteid in self.wa_df['井號']:
+        elif siteid in self.site_rows:
             print('Please input the std_name (法規名稱) in the list: {}'.format(self.std_names))
         elif std_name in self.std_names:
             print('Please check the siteid (井號) again.')
         else:
             print('Both the siteid (井號) and std_name (法規名稱) are incorrect.')
 
-    def plot_line(self, siteid, std_name, savefig=False):
+    def plot_line(self, siteid, std_name, savefig=False, max_points=None, exact=False):
         """
         This function is modified from plot() to draw line indicating
         the values of standards.
         siteid (井號) and std_name (法規名稱) need to be strings.
         Set savefig to True when you wish to output the figures, which
         is in png format (200 dpi).
+        max_points and exact are the same as in plot().
         """
-        import os
-
-        if (siteid in self.wa_df['井號'].unique()) and (std_name in self.std_names):
-            # collect the analytes having value in the standard (std_name) and '日期'
-            cols = np.hstack([self.std_df.loc[~self.std_df[std_name].isna(), '項目'], '日期'])
+        if (siteid in self.site_rows) and (std_name in self.std_names):
+            summary = self.site_summary(siteid)
             # select the data points of that siteid
-            X = self.wa_df[self.wa_df['井號'] == siteid].reset_index(drop=True)
+            X = summary['data']
             # pick up the site name
             site_name = X['井名'][0]
             # select the analytes both have values in the water quality dataset
             # and in the standard.
-            X = X.loc[:, X.columns.isin(cols)]
-            X = X.loc[:, X.any(axis=0)].copy()
+            analytes = summary['analytes'][std_name]
 
-            # the last one is '日期'
-            for analyte in X.columns[:-1]:
+            for analyte in analytes:
                 #with open('results/error.txt', 'a', encoding='utf-8') as f:
                 #    print(analyte, file=f)
-                unit = self.std_df.loc[self.std_df['項目'] == analyte, '單位'].values[0]
-                std_value = self.std_df.loc[self.std_df['項目'] == analyte, std_name].values[0]
+                unit = self.std_idx.loc[analyte, '單位']
+                std_value = self.std_idx.loc[analyte, std_name]
 
                 plt.figure(figsize=(7, 5))
-                plt.plot_date(X.loc[:, '日期'], X.loc[:, analyte], 
+                mask = self.passed(X[analyte], analyte, std_name)
+                Y = X.iloc[plot_index(plt.gca(), X['日期'], X[analyte], mask, max_points, exact)]
+                plt.plot_date(Y.loc[:, '日期'], Y.loc[:, analyte], 
                     c='C0', fmt='o', xdate=True, label=analyte)
                 xlims = plt.gca().get_xlim()
                 # there are three different scenarios about the standard value
@@ -244,94 +1150,104 @@ class Waterquality():
                     else:
                         os.mkdir(self.output_dir)
                     plt.savefig('{}_{}_{}_{}.png'.format(self.output_dir, siteid, std_name, analyte))
-        elif siteid in self.wa_df['井號']:
+        elif siteid in self.site_rows:
             print('Please input the std_name (法規名稱) in the list: {}'.format(self.std_names))
         elif std_name in self.std_names:
             print('Please check the siteid (井號) again.')
         else:
             print('Both the siteid (井號) and std_name (法規名稱) are incorrect.')
 
-    def plot_A4(self, siteid, std_name, savefig=False):
+    def plot_A4(self, siteid, std_name, savefig=False, max_points=None, exact=False):
         """
         This function is modified from plot_line() to draw figures
         in a A4 sheet.
         siteid (井號) and std_name (法規名稱) need to be strings.
         Set savefig to True when you wish to output the figures, which
         is in png format (200 dpi).
+        max_points and exact are the same as in plot().
+        The pages are drawn on the same A4Template, which is kept in
+        a4_template.
         """
-        import os
-
-        if (siteid in self.wa_df['井號'].unique()) and (std_name in self.std_names):
-            # collect the analytes having value in the standard (std_name) and '日期'
-            cols = np.hstack([self.std_df.loc[~self.std_df[std_name].isna(), '項目'], '日期'])
+        if (siteid in self.site_rows) and (std_name in self.std_names):
+            summary = self.site_summary(siteid)
             # select the data points of that siteid
-            X = self.wa_df[self.wa_df['井號'] == siteid].reset_index(drop=True)
+            X = summary['data']
             # pick up the site name
             site_name = X['井名'][0]
             # select the analytes both have values in the water quality dataset
             # and in the standard.
-            X = X.loc[:, X.columns.isin(cols)]
-            X = X.loc[:, X.any(axis=0)].copy()
+            analytes = summary['analytes'][std_name]
 
-            # the last one is '日期'
-            analytes = X.columns[:-1]
+            if getattr(self, 'a4_template', None) is None:
+                self.a4_template = A4Template()
+            units = self.std_idx.loc[analytes, '單位'].values
+            passed = pd.DataFrame({_: self.passed(X[_], _, std_name) for _ in analytes})
             fig_amount = len(analytes)//6 + 1
             for fig_idx in range(fig_amount):
-                # the fig size is slightly smaller than A4 
-                # (8.27, 11.69) because the fig will be shrinked
-                # when pasting into word.
-                fig, axes = plt.subplots(3, 2, figsize=(8, 11.2), gridspec_kw={'width_ratios': [1, 1]})
-                for analyte, ax in zip(analytes[fig_idx*6: fig_idx*6+6], axes.ravel()):
-                    #with open('results/error.txt', 'a', encoding='utf-8') as f:
-                    #    print(analyte, file=f)
-                    unit = self.std_df.loc[self.std_df['項目'] == analyte, '單位'].values[0]
-                    std_value = self.std_df.loc[self.std_df['項目'] == analyte, std_name].values[0]
-
-                    ax.plot_date(X.loc[:, '日期'], X.loc[:, analyte], 
-                        c='C0', fmt='o', xdate=True, label=analyte)
-                    xlims = ax.get_xlim()
-                    # there are three different scenarios about the standard value
-                    if analyte == '氫離子濃度指數':
-                        std_lims = [float(_) for _ in std_value.split('-')]
-                        ax.hlines(std_lims, xmin = [xlims[0], xlims[0]], 
-                            xmax = [xlims[1], xlims[1]], linestyles='dashed', 
-                            colors='r', label='建議區間')
-
-                    elif analyte == '溶氧量':
-                        ax.hlines(std_value, xmin=xlims[0], 
-                            xmax=xlims[1], linestyles='dashed', 
-                            colors='r', label='下限')
-                    else:
-                        ax.hlines(std_value, xmin=xlims[0], 
-                            xmax=xlims[1], linestyles='dashed', 
-                            colors='r', label='上限')
-
-                    ax.set_xlabel('日期')
-                    ax.set_ylabel('{} ({})'.format(analyte, unit))
-                    ax.legend()
-                    plt.setp(ax.get_xticklabels(), rotation=30, ha='right')
-                    #plt.xticks(rotation=30) 
-                    #plt.show()
-                #fig.autofmt_xdate(rotation=30)    
-                fig.suptitle('{}, {}'.format(site_name, std_name))
-                fig.subplots_adjust(top=.96)
-                plt.tight_layout()
+                page = slice(fig_idx*6, fig_idx*6+6)
+                fields = dict(siteid=siteid, std_name=std_name, page=fig_idx, rows=len(X))
+                with self.instrument.stage('plot_A4.draw', **fields):
+                    self.a4_template.draw(
+                        X['日期'], X[analytes[page]], units[page], 
+                        self.std_lo.loc[analytes[page], std_name].values,
+                        self.std_up.loc[analytes[page], std_name].values,
+                        title='{}, {}'.format(site_name, std_name),
+                        passed=passed[analytes[page]], max_points=max_points, exact=exact
+                    )
                 # output figure when savefig is True
                 if savefig:
-                    if os.path.isdir('{}batch/'.format(self.output_dir)):
-                        pass
-                    else:
-                        os.mkdir('{}batch/'.format(self.output_dir))
-                    plt.savefig('{}batch/{}_{}_{}.png'.format(self.output_dir, siteid, std_name, fig_idx))
-                # close the current figure to avoid memery consuming
-                plt.close(fig)
-        elif siteid in self.wa_df['井號']:
+                    # other processes of run() may create it at the same time
+                    os.makedirs('{}batch/'.format(self.output_dir), exist_ok=True)
+                    with self.instrument.stage('plot_A4.savefig', **fields):
+                        self.a4_template.fig.savefig('{}batch/{}_{}_{}.png'.format(self.output_dir, siteid, std_name, fig_idx))
+        elif siteid in self.site_rows:
             print('Please input the std_name (法規名稱) in the list: {}'.format(self.std_names))
         elif std_name in self.std_names:
             print('Please check the siteid (井號) again.')
         else:
             print('Both the siteid (井號) and std_name (法規名稱) are incorrect.')
 
+    def __getstate__(self):
+        # the figure template is rebuilt in every process
+        state = self.__dict__.copy()
+        state['a4_template'] = None
+        # and so are the summaries of the sites
+        state['summaries'] = SummaryCache(self.summaries.maxsize)
+        return state
+
+    def MarkbySTDs(self, df, std_names=None):
+        """
+        This is MarkbySTD() for several standards at once. std_names
+        is a list of std_name (法規名稱), using all of them by default.
+        The output is like in MarkbySTD, but having a column of the 
+        checked result for each standard instead of wa_check.
+        """
+        if std_names is None:
+            std_names = self.std_names
+        wrong = [_ for _ in std_names if _ not in self.std_names]
+        if len(wrong) > 0:
+            print('Please input the std_name (法規名稱) in the list: {}'.format(self.std_names))
+            return
+        with self.instrument.stage('MarkbySTD', rows=len(df), standards=len(std_names)):
+            return self._MarkbySTDs(df, std_names)
+
+    def _MarkbySTDs(self, df, std_names):
+        df['井號'] = df['井號'].astype(str)
+        # if the ratio of passed measurement and total amount of values (exclude None)
+        # is lee than 0.8 in an analyte, this siteid will be marked "no"
+        failed = (self.pass_rates()[std_names] < 0.8).groupby(level='井號', sort=False).any()
+        check_df = ~failed
+        # There might be site not having measurement at all
+        for siteid in df['井號'].unique():
+            if siteid not in check_df.index:
+                print('{} has no water quality measurement'.format(siteid))
+        check_df = check_df.reindex(df['井號'].unique(), fill_value=False)
+        # group the rows by siteid in the order of appearance
+        codes, _ = pd.factorize(df['井號'])
+        out_df = df.iloc[np.argsort(codes, kind='mergesort')].copy()
+        for std_name in std_names:
+            out_df[std_name] = check_df.loc[out_df['井號'], std_name].values
+        return out_df
 
     def MarkbySTD(self, df, std_name):
         """
@@ -343,68 +1259,182 @@ class Waterquality():
         and the checked result of the input sites.
         """
         if std_name in self.std_names:
-            df['井號'] = df['井號'].astype(str)
-            check_list=[]
-            out_df = pd.DataFrame()
-            for siteid in df['井號'].unique():
-                check = True
-                # collect the analytes having value in the standard (std_name) and '日期'
-                cols = np.hstack([self.std_df.loc[~self.std_df[std_name].isna(), '項目'], '日期'])
-                # select the data points of that siteid
-                X = self.wa_df[self.wa_df['井號'] == siteid].reset_index(drop=True)
-                # There might be site not having measurement at all
-                if len(X) > 0:
-                    # select the analytes both have values in the water quality dataset
-                    # and in the standard.
-                    X = X.loc[:, X.columns.isin(cols)]
-                    X = X.loc[:, X.any(axis=0)].copy()
-                    # the last one is '日期'
-                    for analyte in X.columns[:-1]:
-                        std_value = self.std_df.loc[self.std_df['項目'] == analyte, std_name].values[0]
-                        # there are three different scenarios about the standard value
-                        if analyte == '氫離子濃度指數':
-                            lo_lim, up_lim = [float(_) for _ in std_value.split('-')]
-                            mask = (X[analyte] >= lo_lim) & (X[analyte] <= up_lim)
-                        elif analyte == '溶氧量':
-                            mask = X[analyte] > std_value
-                        else:
-                            mask = X[analyte] < std_value
-                        # if the ratio of passed measurement and total amount of values (exclude None)
-                        # is lee than 0.8 in an analyte, this siteid will be marked "no"
-                        pass_rate = mask.sum()/(~X[analyte].isna()).sum()
-                        if pass_rate < 0.8: 
-                            check = False
-                else:
-                    print('{} has no water quality measurement'.format(siteid))
-                    check = False
-                check_list.append(check)
-                out_df = pd.concat([out_df, df[df['井號'] == siteid]], join='outer', axis=0)
-            #out_df = out_df.T
-            out_df['wa_check'] = check_list
-            return out_df
+            out_df = self.MarkbySTDs(df, [std_name])
+            return out_df.rename(columns={std_name: 'wa_check'})
         else:
             print('Please input the std_name (法規名稱) in the list: {}'.format(self.std_names))
 
-    def run(self):
-        select = Waterquality()
-        for siteid in self.wa_df['井號'].unique():
-            for std_name in self.std_names:
-                select.plot_A4(siteid=siteid, std_name=std_name, savefig=True)
+    def run(self, processes=1, siteids=None, std_names=None):
+        """
+        Output the plot_A4 figures of every siteid (井號) and std_name
+        (法規名稱), or the ones in the lists of siteids and std_names.
+        Set processes to more than 1 to draw the figures by a pool of
+        processes, using the Agg backend. The progress is printed for
+        every figure set and a failed one doesn't stop the others.
+        The output is a list of (siteid, std_name, error) of the 
+        failed ones, which are also written into error.txt in the
+        output_dir.
+        """
+        if siteids is None:
+            siteids = self.wa_df['井號'].unique()
+        if std_names is None:
+            std_names = self.std_names
+        jobs = [(siteid, std_name) for siteid in siteids for std_name in std_names]
+        with self.instrument.stage('run', jobs=len(jobs), processes=processes) as record:
+            failed = self._run(jobs, processes)
+            record['failed'] = len(failed)
+        return failed
+
+    def _run(self, jobs, processes):
+        global _worker
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        failed = []
+        if processes > 1:
+            # the data is sent once to each process instead of each job
+            with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(self,)) as pool:
+                futures = {pool.submit(_run_job, *job): job for job in jobs}
+                for i, future in enumerate(as_completed(futures)):
+                    self._report(i, jobs, futures[future], _job_error(future), failed)
+        else:
+            # A4Template draws on a plain Figure, so the backend of this
+            # process (e.g. in a notebook) is kept
+            _worker = self
+            for i, job in enumerate(jobs):
+                self._report(i, jobs, job, _run_job(*job), failed)
+        if len(failed) > 0:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open('{}error.txt'.format(self.output_dir), 'w', encoding='utf-8') as f:
+                for siteid, std_name, error in failed:
+                    print('{}, {}\n{}'.format(siteid, std_name, error), file=f)
+        return failed
+
+    def _report(self, i, jobs, job, error, failed):
+        if error is None:
+            print('[{}/{}] {}, {}'.format(i+1, len(jobs), *job))
+        else:
+            print('[{}/{}] {}, {} failed: {}'.format(i+1, len(jobs), *job, error.splitlines()[-1]))
+            failed.append((*job, error))
+
+class A4Template():
+    """
+    A pre-built A4 sheet of 3 x 2 axes for Waterquality.plot_A4(). The
+    axes, legends and title are built once, and every page only swaps
+    the data and labels. The figure is not managed by pyplot, so it
+    works with any backend and is never shown.
+    """
+
+    def __init__(self):
+        from matplotlib.figure import Figure
+
+        # the fig size is slightly smaller than A4 
+        # (8.27, 11.69) because the fig will be shrinked
+        # when pasting into word.
+        self.fig = Figure(figsize=(8, 11.2))
+        self.axes = self.fig.subplots(3, 2, gridspec_kw={'width_ratios': [1, 1]}).ravel()
+        self.title = self.fig.suptitle('')
+        self.lines = []
+        for ax in self.axes:
+            ax.xaxis_date()
+            data, = ax.plot([], [], 'o', c='C0', label=' ')
+            # the lower and upper limits of the standard
+            lo, = ax.plot([], [], '--', c='r', label=' ')
+            up, = ax.plot([], [], '--', c='r')
+            legend = ax.legend(handles=[data, lo])
+            ax.set_xlabel('日期')
+            self.lines.append((data, lo, up, legend))
+
+    def draw(self, dates, X, units, lo_lims, up_lims, title, passed=None, 
+        max_points=None, exact=False):
+        """
+        Draw a page. dates is the x of all analytes, X is a 
+        pd.DataFrame of at most 6 analytes, units, lo_lims and up_lims
+        are their units and limits of the standard (NaN if no limit). 
+        The unused axes are hidden.
+        passed is a pd.DataFrame like X marking the values passing the
+        standard, max_points and exact are used for plot_index().
+        """
+        import matplotlib.dates as mdates
+
+        x = mdates.date2num(dates)
+        for i, (ax, (data, lo, up, legend)) in enumerate(zip(self.axes, self.lines)):
+            if i >= X.shape[1]:
+                ax.set_visible(False)
+                continue
+            ax.set_visible(True)
+            analyte = X.columns[i]
+            mask = np.ones(len(X), dtype=bool) if passed is None else passed[analyte].values
+            shown = plot_index(ax, dates, X[analyte].values, mask, max_points, exact)
+            data.set_data(x[shown], X[analyte].values[shown])
+            lo.set_data([], [])
+            up.set_data([], [])
+            ax.relim()
+            ax.autoscale_view()
+            xlims = ax.get_xlim()
+            # there are three different scenarios about the standard value
+            if not np.isnan(lo_lims[i]) and not np.isnan(up_lims[i]):
+                label = '建議區間'
+            elif not np.isnan(lo_lims[i]):
+                label = '下限'
+            else:
+                label = '上限'
+            if not np.isnan(lo_lims[i]):
+                lo.set_data(xlims, [lo_lims[i]]*2)
+            if not np.isnan(up_lims[i]):
+                up.set_data(xlims, [up_lims[i]]*2)
+            ax.relim()
+            ax.autoscale_view()
+            ax.set_ylabel('{} ({})'.format(analyte, units[i]))
+            legend.get_texts()[0].set_text(analyte)
+            legend.get_texts()[1].set_text(label)
+            plt.setp(ax.get_xticklabels(), rotation=30, ha='right')
+        self.title.set_text(title)
+        self.fig.subplots_adjust(top=.96)
+        self.fig.tight_layout()
+
+# the Waterquality in a process of Waterquality.run()
+_worker = None
+
+def _init_worker(select):
+    global _worker
+    plt.switch_backend('Agg')
+    _worker = select
+
+def _run_job(siteid, std_name):
+    import traceback
+
+    try:
+        with _worker.instrument.stage('run.job', siteid=siteid, std_name=std_name):
+            _worker.plot_A4(siteid=siteid, std_name=std_name, savefig=True)
+    except Exception:
+        return traceback.format_exc()
+
+def _job_error(future):
+    # the error of a job, also when its process died (BrokenProcessPool)
+    import traceback
+
+    try:
+        return future.result()
+    except Exception:
+        return traceback.format_exc()
 
 # test
 if __name__ == '__main__':
     select = Waterquality()
     #select.plot_A4(siteid='4413', std_name='地下水污染監測標準第一類', savefig=True)
     select.run()
-    #merge_df = pd.read_hdf('data/database_ZAF_clean_gps_20211104.hd5', key='wl')
-    #mask = (merge_df['日期時間']>='2021-05-01') & (merge_df['日期時間']<'2021-05-15')
-    #df = merge_df[mask].copy()
-    #df.to_csv('data/test.csv', index=False)
-    #df = pd.read_csv('data/test.csv')
     #select = Waterlvl()
+    #df = select.read(store_dir='data/database_ZAF_wl.hd5', start='2021-05-01', end='2021-05-15')
     #df = select.MarkbyEP(df=df)
+    # or stream the windows of a longer period
+    #df = select.MarkbyEP(df=select.read(start='2021-01-01', end='2021-07-01', window='7D'))
     #print(out_df.shape, len(check_list))
     #with open('results/error.txt', 'w+', encoding='utf-8') as f:
     #    print(out_df, file=f)
     #select = Waterquality()
-    #select.MarkbySTD(df=df, std_name='再生水用於工業用途水質基礎建議值一').to_csv('results/out.csv')
\ No newline at end of file
+    #select.MarkbySTD(df=df, std_name='再生水用於工業用途水質基礎建議值一').to_csv('results/out.csv')
+    # the fit of a monitor goes on after a missing measurement
+    #monitor = WaterlvlMonitor(window=5)
+    #for time, depth in zip(pd.date_range('2021-05-01', periods=11, freq='H'), [5, 6, np.nan] + list(range(7, 15))):
+    #    monitor.update('2050311', time, depth)
+    #print(monitor.slope('2050311'), monitor.wells['2050311']['depth'])  # 1.0 14.0
\ No newline at end of file
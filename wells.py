@@ -0,0 +1,179 @@
+"""
+This module is built for the well list (環保署水利署地下水井.xlsx) and
+selecting the wells by area. The coordinates are attached to the data
+in one merge, and the wells are kept in a projected GeoDataFrame with
+a spatial index, so the wells in a polygon (e.g. a township), within
+a radius or nearest to a point are found without going through the
+data. The outputs are lists of 井號 for MarkbyEP and MarkbySTD, e.g.
+    registry = WellRegistry()
+    siteids = registry.radius(120.45, 23.75, 5000)
+    df = df[df['井號'].isin(siteids)]
+geopandas (with rtree or pygeos) is needed for the queries only.
+"""
+import numpy as np
+import pandas as pd
+
+def normalize_id(ids):
+    """
+    井號 in string without the leading zeros, since the ids are read
+    as numbers in the well list (e.g. 02050311 is 2050311).
+    """
+    ids = pd.Series(ids).astype(str).str.strip()
+    # the ids read as float, e.g. 2050311.0
+    ids = ids.str.replace(r'\.0$', '', regex=True)
+    return ids.str.lstrip('0').values
+
+def read_wells(well_dir):
+    """
+    Read the well list with columns of 井號 (by normalize_id()),
+    SiteName, Lon and Lat (TWD97Lon and TWD97Lat, in degree).
+    """
+    wells = pd.read_excel(well_dir)
+    return pd.DataFrame({
+        '井號': normalize_id(wells['SiteId']),
+        'SiteName': wells['SiteName'].values,
+        'Lon': wells['TWD97Lon'].values,
+        'Lat': wells['TWD97Lat'].values,
+    }).drop_duplicates('井號')
+
+class WellRegistry():
+    """
+    This is a class to attach the coordinates of the wells and select
+    the wells by area. The wells are projected to crs (TWD97 TM2, in
+    meter, by default) once, and the distances are in the unit of crs.
+    The points given to the queries are in src_crs (the degrees of the
+    well list) unless another crs is given.
+    """
+
+    def __init__(
+        self,
+        well_dir = 'data/環保署水利署地下水井.xlsx',
+        crs = 'EPSG:3826',
+        src_crs = 'EPSG:4326',
+        cache_dir = 'data/cache/'
+    ):
+        import datacache
+
+        # the parsed file is cached in cache_dir (None to disable)
+        self.wells = datacache.load(well_dir, read_wells, cache_dir=cache_dir)
+        self.crs = crs
+        self.src_crs = src_crs
+        self._gdf = None
+
+    @classmethod
+    def from_frame(cls, wells, crs='EPSG:3826', src_crs='EPSG:4326'):
+        """
+        Create a WellRegistry from a pd.DataFrame like the output of
+        read_wells() instead of the file.
+        """
+        registry = cls.__new__(cls)
+        registry.wells = wells.assign(井號=normalize_id(wells['井號'])).drop_duplicates('井號')
+        registry.crs = crs
+        registry.src_crs = src_crs
+        registry._gdf = None
+        return registry
+
+    def attach(self, df, name=True, how='inner', normalize=True):
+        """
+        Attach Lon and Lat (and 井名 from SiteName if name is True) to
+        df by 井號 in one merge. With how='inner', the rows of the wells
+        not in the list are dropped. 井號 of the output is normalized
+        by normalize_id(). Set normalize to False if 井號 of df is 
+        normalized already.
+        """
+        if normalize:
+            df = df.assign(井號=normalize_id(df['井號']))
+        if name:
+            wells = self.wells.rename(columns={'SiteName': '井名'})
+            df = df.drop([_ for _ in ['井名', 'Lon', 'Lat'] if _ in df.columns], axis=1)
+        else:
+            wells = self.wells.drop('SiteName', axis=1)
+            df = df.drop([_ for _ in ['Lon', 'Lat'] if _ in df.columns], axis=1)
+        return df.merge(wells, on='井號', how=how)
+
+    @property
+    def gdf(self):
+        """
+        The wells having coordinates as a GeoDataFrame indexed by 井號
+        in crs, built once. Its spatial index is gdf.sindex.
+        """
+        if self._gdf is None:
+            import geopandas as gpd
+
+            wells = self.wells.dropna(subset=['Lon', 'Lat'])
+            gdf = gpd.GeoDataFrame(
+                wells.set_index('井號'),
+                geometry=gpd.points_from_xy(wells['Lon'], wells['Lat']),
+                crs=self.src_crs
+            ).to_crs(self.crs)
+            # build the spatial index now instead of the first query
+            gdf.sindex
+            self._gdf = gdf
+        return self._gdf
+
+    def project(self, geometry, crs=None):
+        """
+        Project a shapely geometry from crs (src_crs by default) to the
+        crs of the registry.
+        """
+        import geopandas as gpd
+
+        return gpd.GeoSeries([geometry], crs=self.src_crs if crs is None else crs).to_crs(self.crs).iloc[0]
+
+    def within(self, polygon, crs=None):
+        """
+        井號 of the wells in (or on the boundary of) the shapely polygon
+        in crs (src_crs by default).
+        """
+        polygon = self.project(polygon, crs)
+        idx = self.gdf.sindex.query(polygon, predicate='intersects')
+        return list(self.gdf.index[np.sort(idx)])
+
+    def radius(self, x, y, distance, crs=None):
+        """
+        井號 of the wells within the distance (in the unit of the crs of
+        the registry) from the point (x, y) in crs (src_crs by default),
+        from the nearest.
+        """
+        from shapely.geometry import Point
+
+        point = self.project(Point(x, y), crs)
+        idx, dist = self.candidates(point, distance)
+        return list(self.gdf.index[idx[dist <= distance]])
+
+    def nearest(self, x, y, k=1, crs=None):
+        """
+        井號 of the k wells nearest to the point (x, y) in crs (src_crs
+        by default), from the nearest. The wells are found by the
+        spatial index in a box growing from the point, starting from 
+        the size having about k wells if they were evenly spread.
+        """
+        from shapely.geometry import Point
+
+        point = self.project(Point(x, y), crs)
+        k = min(k, len(self.gdf))
+        if k <= 0:
+            return []
+        minx, miny, maxx, maxy = self.gdf.total_bounds
+        distance = max(np.sqrt((maxx - minx)*(maxy - miny)*k/len(self.gdf)/np.pi), 1.)
+        while True:
+            idx, dist = self.candidates(point, distance)
+            # the k nearest ones are all in the box if the kth one is 
+            # within the distance
+            if len(idx) >= k and dist[k - 1] <= distance:
+                return list(self.gdf.index[idx[:k]])
+            distance *= 2
+
+    def candidates(self, point, distance):
+        """
+        The positions of the wells in the box of the distance around 
+        the (projected) point by the spatial index, and their distances
+        to the point, from the nearest.
+        """
+        from shapely.geometry import box
+
+        idx = np.sort(self.gdf.sindex.query(box(point.x - distance, point.y - distance,
+            point.x + distance, point.y + distance)))
+        dist = self.gdf.geometry.iloc[idx].distance(point).values
+        order = np.argsort(dist, kind='mergesort')
+        return idx[order], dist[order]